@@ -1,15 +1,64 @@
+import threading
+import time
+from collections import OrderedDict
+from itertools import chain
+
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 
 from flask import current_app
 
 from app.extensions import db, login_manager
 
 
+# Principal cache. Maps a user id to (loaded_at, Principal) so that loading
+# the logged user and checking its permissions costs no queries. Entries
+# are dropped when the user or a role is written through this process;
+# other processes pick the change up when PRINCIPAL_CACHE_TTL expires.
+# Only the PRINCIPAL_CACHE_SIZE most recently used principals are kept.
+
+principal_cache = OrderedDict()
+_principal_lock = threading.Lock()
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    with _principal_lock:
+        cached = principal_cache.get(user_id)
+        if cached is not None:
+            principal_cache.move_to_end(user_id)
+    if cached is not None:
+        loaded_at, principal = cached
+        if time.monotonic() - loaded_at < \
+                current_app.config['PRINCIPAL_CACHE_TTL']:
+            return principal
+    row = db.session.query(
+        User.id, User.email, User.confirmed, Role.permissions).outerjoin(
+        Role, User.role).filter(User.id == user_id).first()
+    if row is None:
+        invalidate_principal(user_id)
+        return None
+    principal = Principal(*row)
+    with _principal_lock:
+        principal_cache[user_id] = (time.monotonic(), principal)
+        principal_cache.move_to_end(user_id)
+        while len(principal_cache) > \
+                current_app.config['PRINCIPAL_CACHE_SIZE']:
+            principal_cache.popitem(last=False)
+    return principal
+
+
+def invalidate_principal(user_id=None):
+    """Drop the cached principal of `user_id`, or every one if None"""
+    with _principal_lock:
+        if user_id is None:
+            principal_cache.clear()
+        else:
+            principal_cache.pop(user_id, None)
 
 
 class Permission:
@@ -52,6 +101,37 @@ class Role(db.Model):
         return '<Role %r>' % self.name
 
 
+class Principal(UserMixin):
+    """
+    The logged user as seen by the request: what is needed to authorize
+    it, without a database session. Use `user` to get the User itself.
+    """
+
+    def __init__(self, id, email, confirmed, permissions):
+        self.id = id
+        self.email = email
+        self.confirmed = bool(confirmed)
+        self.permissions = permissions
+
+    @property
+    def user(self):
+        return User.query.get(self.id)
+
+    def can(self, permissions: int):
+        return self.permissions is not None and \
+            (self.permissions & permissions) == permissions
+
+    def is_administrator(self):
+        return self.can(Permission.ADMINISTER)
+
+    def generate_confirmation_token(self):
+        serializer = Serializer(current_app.config['SECRET_KEY'])
+        return serializer.dumps({'confirm': self.id})
+
+    def __repr__(self):
+        return '<Principal %r>' % self.email
+
+
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
@@ -78,10 +158,12 @@ class User(UserMixin, db.Model):
 
     @classmethod
     def get_stock_alert_emails(cls):
-        return [
-            u.email for u in User.query.all()
-            if u.is_administrator() and u.stock_mail_alert
-        ]
+        """Emails of the administrators who asked for stock alerts"""
+        rows = db.session.query(cls.email).join(Role, cls.role).filter(
+            cls.stock_mail_alert == db.true(),
+            Role.permissions.op('&')(Permission.ADMINISTER) ==
+            Permission.ADMINISTER).order_by(cls.email)
+        return [email for email, in rows]
 
     def can(self, permissions: int):
         return self.role is not None and \
@@ -121,6 +203,41 @@ class User(UserMixin, db.Model):
         return '<User %r>' % self.email
 
 
+# Serves the prefix matches of the typeahead search (lower(email) LIKE 'x%')
+db.Index('ix_users_lower_email',
+         db.func.lower(User.email).label('lower_email'),
+         postgresql_ops={'lower_email': 'varchar_pattern_ops'})
+
+# Few users ask for stock alerts, see get_stock_alert_emails
+db.Index('ix_users_stock_mail_alert', User.email,
+         postgresql_where=User.stock_mail_alert == db.true())
+
+
+@event.listens_for(Session, 'after_flush')
+def track_principal_writes(session, flush_context):
+    # A role change affects every user holding it
+    changed = session.info.setdefault('changed_principals', set())
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, Role):
+            changed.add(None)
+        elif isinstance(instance, User):
+            changed.add(instance.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_principals_on_commit(session):
+    changed = session.info.pop('changed_principals', ())
+    if None in changed:
+        invalidate_principal()
+    else:
+        for user_id in changed:
+            invalidate_principal(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_principal_writes(session):
+    session.info.pop('changed_principals', None)
+
 
 class PreAllowedUser(db.Model):
     """Table storing users that are directly added as 'Staff'"""
@@ -54,7 +54,7 @@ def register():
         if user.email in PreAllowedUser.get_emails():
             user.role = Role.query.filter_by(name='Staff').first()
         db.session.add(user)
-        db.session.commit()
+        db.session.flush()
         token = user.generate_confirmation_token()
         send_email(
             recipients=[user.email],
@@ -62,6 +62,7 @@ def register():
             template='auth/email/confirm',
             user=user,
             token=token)
+        db.session.commit()
         flash('Uma mensagem de confirmação foi enviada para seu email.',
               'success')
         return redirect(url_for(current_app.config.get('MAIN_ENDPOINT')))
@@ -73,7 +74,8 @@ def register():
 def confirm(token):
     if current_user.confirmed:
         return redirect(url_for(current_app.config.get('MAIN_ENDPOINT')))
-    if current_user.confirm(token):
+    if current_user.user.confirm(token):
+        db.session.commit()
         flash('Conta verificada. Obrigado!', 'warning')
     else:
         flash('O link de confirmação não é válido ou expirou.', 'warning')
@@ -106,6 +108,7 @@ def resend_confirmation():
         template='auth/email/confirm',
         user=current_user,
         token=token)
+    db.session.commit()
     flash('Uma nova mensagem de confirmação foi enviada ao seu email.',
           'success')
     return redirect(url_for(current_app.config.get('MAIN_ENDPOINT')))
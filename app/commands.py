@@ -1,6 +1,39 @@
 import click
 
 
+# Queries behind the most used pages, with the indexes meant to serve them.
+# Used by the `explain` command.
+HOT_QUERIES = [
+    ('Transactions list (/transactions)',
+     'SELECT * FROM transactions ORDER BY updated_on DESC, id DESC LIMIT 50'),
+    ('Orders list (/orders)',
+     'SELECT * FROM orders ORDER BY order_date DESC, id DESC LIMIT 50'),
+    ('Incremental orders export (/export/orders?since=...)',
+     "SELECT * FROM orders WHERE (updated_on, id) > ('2020-01-01', 0) \
+        ORDER BY updated_on, id LIMIT 50"),
+    ('Manufacturer by lot number (/products/consume)',
+     "SELECT s.manufacturer FROM specifications s \
+        JOIN order_items oi ON (oi.item_id = s.id) \
+        WHERE oi.lot_number = 'LOT-1' LIMIT 1"),
+    ('Specifications of a product (/products/<id>)',
+     'SELECT * FROM specifications WHERE product_id = 1'),
+    ('Stock products by expiration date (stock_products export)',
+     'SELECT * FROM stock_products ORDER BY expiration_date LIMIT 50'),
+    ('Product typeahead (/search/products)',
+     "SELECT * FROM products WHERE lower(name) LIKE 'prod%' \
+        ORDER BY name LIMIT 20"),
+]
+HOT_PATH_INDEXES = [
+    'ix_transactions_updated_on_id',
+    'ix_orders_order_date_id',
+    'ix_orders_updated_on_id',
+    'ix_order_items_lot_number_item_id',
+    'ix_specifications_product_id',
+    'ix_stock_products_expiration_date',
+    'ix_products_lower_name',
+]
+
+
 def register_commands(app):
     from app.extensions import db
     import app.auth as auth
@@ -27,6 +60,165 @@ def register_commands(app):
         Stock.insert_main_stock()
         app.logger.info('main stock created successfully')
 
+    @app.cli.command()
+    @click.option('--products', default=2000, show_default=True,
+                  type=click.IntRange(min=1))
+    @click.option('--users', default=50, show_default=True,
+                  type=click.IntRange(min=1))
+    @click.option('--orders', default=5000, show_default=True,
+                  type=click.IntRange(min=0))
+    @click.option('--transactions', default=100000, show_default=True,
+                  type=click.IntRange(min=0),
+                  help='Consumptions, one SUB transaction each')
+    @click.option('--months', default=24, show_default=True,
+                  type=click.IntRange(min=1),
+                  help='How far back orders and consumptions go')
+    @click.option('--seed', 'random_seed', default=0, show_default=True,
+                  help='Same seed and options, same data')
+    def seed(products, users, orders, transactions, months, random_seed):
+        """
+        Fill the database with a synthetic inventory (users, products,
+        specifications, orders, lots and months of transactions), to
+        reproduce production-sized pages locally. Existing data is kept;
+        seeded users log in with the password "password".
+        """
+        import time
+        from app.main.seed import seed as seed_database
+        started = time.monotonic()
+
+        def progress(table, rows):
+            click.echo(f'{rows} {table} inserted '
+                       f'({time.monotonic() - started:.1f}s)')
+
+        seed_database(products, users, orders, transactions, months,
+                      random_seed, progress)
+        app.logger.info('Database seeded')
+
+    @app.cli.command()
+    @click.option('--compare', is_flag=True,
+                  help='Also show the plans without the hot path indexes')
+    def explain(compare):
+        """
+        Show EXPLAIN ANALYZE plans of the hot query paths.
+
+        With --compare the hot path indexes are dropped inside a transaction
+        that is rolled back afterwards. DROP INDEX locks the tables while it
+        runs, so only compare against a development database.
+        """
+        def get_plans():
+            plans = []
+            for _, query in HOT_QUERIES:
+                rows = db.session.execute('EXPLAIN ANALYZE ' + query)
+                plans.append('\n'.join(row[0] for row in rows))
+            return plans
+
+        plans_without_indexes = None
+        if compare:
+            for index in HOT_PATH_INDEXES:
+                db.session.execute(f'DROP INDEX IF EXISTS {index}')
+            plans_without_indexes = get_plans()
+            db.session.rollback()
+        plans = get_plans()
+        db.session.rollback()
+
+        for i, (name, query) in enumerate(HOT_QUERIES):
+            click.echo(f'=== {name}\n{" ".join(query.split())}')
+            if plans_without_indexes:
+                click.echo(f'--- without indexes\n{plans_without_indexes[i]}')
+                click.echo('--- with indexes')
+            click.echo(plans[i] + '\n')
+
+    @app.cli.command('export')
+    @click.argument('table')
+    @click.option('--format', 'export_format', default='csv',
+                  help='csv, csv.gz, ndjson, ndjson.gz or xlsx')
+    @click.option('--since',
+                  help='Watermark printed by a previous export of the table')
+    @click.option('--output', type=click.Path(dir_okay=False),
+                  help='Output file, defaults to <table>.<format>')
+    def export_command(table, export_format, since, output):
+        """
+        Export a table to a file. For transactions and orders the next
+        watermark is printed, pass it as --since to only export the rows
+        created or updated after this export.
+        """
+        from app.main.utils import get_export, write_export
+        try:
+            _, chunks, watermark = get_export(table, export_format, since)
+        except ValueError as err:
+            raise click.UsageError(str(err))
+        output = output or f'{table}.{export_format}'
+        with open(output, 'wb') as output_file:
+            write_export(chunks, output_file)
+        app.logger.info(f'{table} exported to {output}')
+        if watermark is not None:
+            click.echo(watermark)
+
+    @app.cli.command('import-catalog')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--batch-size', type=click.IntRange(min=1), default=1000,
+                  show_default=True)
+    def import_catalog_command(path, batch_size):
+        """
+        Import products and specifications from a CSV or XLSX file with the
+        columns of the products export: reativo, fabricante, catalogo,
+        unidade_de_estoque and estoque_minimo. Existing products and
+        specifications are skipped.
+        """
+        from app.main.services import import_catalog
+        from app.main.utils import read_table_rows
+
+        def progress(result):
+            click.echo(f'{result.rows} rows read, '
+                       f'{result.products} products and '
+                       f'{result.specifications} specifications created, '
+                       f'{len(result.errors)} errors')
+
+        result = import_catalog(read_table_rows(path), batch_size, progress)
+        for number, message in result.errors:
+            click.echo(f'Row {number}: {message}', err=True)
+        app.logger.info(f'Catalog imported from {path}')
+
+    @app.cli.command('export-bundle')
+    @click.option('--tables', help='Comma separated tables, defaults to all')
+    @click.option('--output', type=click.Path(dir_okay=False),
+                  default='bundle.zip', show_default=True)
+    def export_bundle_command(tables, output):
+        """
+        Export tables concurrently, from one consistent snapshot, to a ZIP
+        file with one CSV per table and a manifest.json.
+        """
+        from app.main.utils import generate_bundle
+        try:
+            chunks = generate_bundle(tables.split(',') if tables else None)
+        except ValueError as err:
+            raise click.UsageError(str(err))
+        with open(output, 'wb') as output_file:
+            for chunk in chunks:
+                output_file.write(chunk)
+        app.logger.info(f'Tables exported to {output}')
+
+    @app.cli.command('mail-worker')
+    @click.option('--batch-size', type=click.IntRange(min=1),
+                  help='Defaults to MAIL_BATCH_SIZE')
+    @click.option('--interval', type=float,
+                  help='Seconds between outbox polls, defaults to '
+                       'MAIL_WORKER_INTERVAL')
+    @click.option('--once', is_flag=True,
+                  help='Deliver the due emails and exit')
+    def mail_worker_command(batch_size, interval, once):
+        """
+        Deliver the emails queued in the outbox, and the stock alert
+        digests. Several workers may run at once, each email is claimed by
+        only one of them.
+        """
+        from app.utils.email import run_mail_worker
+        from app.main.services import queue_stock_alert_digests
+        app.logger.info('Mail worker started')
+        run_mail_worker(batch_size or app.config['MAIL_BATCH_SIZE'],
+                        interval or app.config['MAIL_WORKER_INTERVAL'],
+                        once, jobs=[queue_stock_alert_digests])
+
     @app.cli.command('t')
     @click.option('--pdb', is_flag=True, help='Enable pdb fallback')
     @click.option('--cov', is_flag=True, help='Enable code coverage')
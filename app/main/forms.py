@@ -5,25 +5,40 @@ from flask_login import current_user
 from wtforms.validators import (DataRequired, InputRequired, NumberRange,
                                 Optional)
 
+from . import services as svc
 from .models import Product, StockProduct, Transaction, Specification
-from app.auth.models import User
+
+
+class SearchSelectField(wtf.SelectField):
+    """
+    Select whose options are searched on demand through a JSON endpoint.
+
+    Only the selected option is rendered. Submitted ids are validated with
+    `lookup`, a callable returning the label of an id or None when the id
+    is not a valid choice.
+    """
+
+    def __init__(self, label=None, validators=None, **kwargs):
+        super().__init__(label, validators, coerce=int, **kwargs)
+        self.lookup = lambda id: None
+
+    def iter_choices(self):
+        label = self.lookup(self.data) if self.data is not None else None
+        if label is not None:
+            yield (self.data, label, True)
+
+    def pre_validate(self, form):
+        if self.data is None or self.lookup(self.data) is None:
+            raise ValueError(self.gettext('Not a valid choice'))
 
 
 class OrderItemForm(FlaskForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        specs = kwargs.get('specs', [])
-        self.item_id.choices = [
-            (s.id, '{} | {} | Catálogo: {} | {} unidades/produto'.format(
-                s.product.name,
-                s.manufacturer,
-                s.catalog_number,
-                s.units)
-             ) for s in specs
-        ]
-
-    item_id = wtf.SelectField(
-        'Reativo', coerce=int, validators=[InputRequired()])
+        self.item_id.lookup = svc.get_specification_label
+
+    item_id = SearchSelectField(
+        'Reativo', validators=[InputRequired()])
     amount = wtf.IntegerField(
         'Quantidade',
         widget=widgets.NumberInput(),
@@ -78,20 +93,42 @@ class OrderForm(FlaskForm):
 class ConsumeProductForm(FlaskForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        stock_products = kwargs.get('stock_products', [])
-        self.stock_product_id.choices = [
-            (sp.id, (f'''
-                {sp.product.name}
-                 | Lote: {sp.lot_number}
-                 | Validade: {sp.expiration_date.strftime('%d-%m-%y')}
-                 | Quantidade: {sp.amount}
-                 | Fabricante: {sp.manufacturer}
-            ''')) for sp in stock_products
-        ]
-        self.consumer_id.choices = [(user.id, user.email) for user in User.query.order_by(User.email).all()]
-
-    stock_product_id = wtf.SelectField(
-        'Reativo', coerce=int, validators=[InputRequired()])
+        stock = kwargs['stock']
+        self.stock_product_id.lookup = \
+            lambda id: svc.get_stock_product_label(stock, id)
+        self.consumer_id.lookup = svc.get_user_label
+
+    stock_product_id = SearchSelectField(
+        'Reativo', validators=[InputRequired()])
+    amount = wtf.IntegerField(
+        'Quantidade',
+        validators=[
+            InputRequired(),
+            NumberRange(
+                min=1, max=None, message='Quantidade deve ser maior que zero!')
+        ],
+        widget=widgets.NumberInput(),
+        render_kw={'autocomplete': 'off'},
+        default=1,
+    )
+    consumer_id = SearchSelectField(
+        'Consumidor final',
+        validators=[InputRequired()],
+        default=lambda: current_user.id,
+    )
+    submit = wtf.SubmitField('Confirmar')
+
+
+class ConsumeByProductForm(FlaskForm):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        stock = kwargs['stock']
+        self.product_id.lookup = \
+            lambda id: svc.get_product_in_stock_label(stock, id)
+        self.consumer_id.lookup = svc.get_user_label
+
+    product_id = SearchSelectField(
+        'Reativo', validators=[InputRequired()])
     amount = wtf.IntegerField(
         'Quantidade',
         validators=[
@@ -103,10 +140,10 @@ class ConsumeProductForm(FlaskForm):
         render_kw={'autocomplete': 'off'},
         default=1,
     )
-    consumer_id = wtf.SelectField(
+    consumer_id = SearchSelectField(
         'Consumidor final',
-        coerce=int,
         validators=[InputRequired()],
+        default=lambda: current_user.id,
     )
     submit = wtf.SubmitField('Confirmar')
 
@@ -1,10 +1,14 @@
 import jsonpickle
-from datetime import datetime
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
 
 from sqlalchemy import (Column, Integer, String, DateTime, UniqueConstraint,
-                        ForeignKey, Date, Numeric, Boolean, CheckConstraint)
-from sqlalchemy.orm import relationship, backref
-from flask_sqlalchemy import Model
+                        ForeignKey, Date, Numeric, Boolean, CheckConstraint,
+                        Index, DDL, Text, event, func, tuple_)
+from sqlalchemy.orm import (relationship, backref, joinedload,
+                            selectinload, contains_eager, deferred)
+from sqlalchemy.dialects.postgresql import insert, TSVECTOR
+from flask_sqlalchemy import Model, BaseQuery
 
 from app.extensions import db
 from app.logger import logger
@@ -34,6 +38,85 @@ class Base(db.Model):
         return f'<{self.__class__.__name__} ({self.id})>'
 
 
+KeysetPage = namedtuple('KeysetPage', ['items', 'next_cursor', 'prev_cursor'])
+CURSOR_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(value, id):
+    return '{}_{}'.format(value.strftime(CURSOR_DATETIME_FORMAT), id)
+
+
+def decode_cursor(cursor):
+    """Raises ValueError for malformed cursors"""
+    value, id = cursor.rsplit('_', 1)
+    return datetime.strptime(value, CURSOR_DATETIME_FORMAT), int(id)
+
+
+class KeysetQuery(BaseQuery):
+    def keyset_page(self, column, after=None, before=None, per_page=50):
+        """
+        Return a KeysetPage of results ordered by (column, id), newest
+        first. `after` and `before` are cursors taken from a previous page.
+        Rows are located by comparing (column, id) against the cursor,
+        so the cost doesn't grow with the page number.
+        """
+        id_column = column.class_.id
+        key = tuple_(column, id_column)
+        if before is not None:
+            query = self.filter(key > tuple_(*decode_cursor(before))).order_by(
+                column.asc(), id_column.asc())
+        else:
+            query = self
+            if after is not None:
+                query = query.filter(key < tuple_(*decode_cursor(after)))
+            query = query.order_by(column.desc(), id_column.desc())
+        items = query.limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+        if before is not None:
+            items.reverse()
+            has_next, has_prev = True, has_more
+        else:
+            has_next, has_prev = has_more, after is not None
+        if not items:
+            return KeysetPage(items, None, None)
+        first, last = items[0], items[-1]
+        return KeysetPage(
+            items,
+            encode_cursor(getattr(last, column.key), last.id)
+            if has_next else None,
+            encode_cursor(getattr(first, column.key), first.id)
+            if has_prev else None,
+        )
+
+
+# Queries with the relationships each list view renders loaded up front,
+# so a page runs a fixed number of queries whatever its number of rows.
+
+class ProductQuery(BaseQuery):
+    def with_display_relations(self):
+        return self.options(selectinload(Product.specifications))
+
+
+class StockProductQuery(BaseQuery):
+    def with_display_relations(self):
+        """Load the product, joined so results can be ordered by its name"""
+        return self.join(StockProduct.product).options(
+            contains_eager(StockProduct.product))
+
+
+class OrderQuery(KeysetQuery):
+    def with_display_relations(self):
+        return self.options(joinedload(Order.user))
+
+
+class TransactionQuery(KeysetQuery):
+    def with_display_relations(self):
+        return self.options(
+            joinedload(Transaction.product),
+            joinedload(Transaction.user))
+
+
 class TimeStampedModelMixin(db.Model):
     __abstract__ = True
     # Columns
@@ -44,15 +127,29 @@ class TimeStampedModelMixin(db.Model):
 
 class Product(Base):
     __tablename__ = 'products'
+    query_class = ProductQuery
+    __table_args__ = (
+        # Without fastupdate, searches don't have to scan a pending list of
+        # recent insertions
+        Index('ix_products_search_vector', 'search_vector',
+              postgresql_using='gin', postgresql_with={'fastupdate': 'off'}),)
     # Columns
     name = Column(String(255), nullable=False, unique=True)
     stock_minimum = Column(Integer, default=1, nullable=False)
+    # Name, manufacturers and catalog numbers, maintained by the triggers
+    # in PRODUCT_SEARCH_DDL
+    search_vector = deferred(Column(TSVECTOR, nullable=True))
     # Relationships
     specifications = relationship('Specification',
                                   cascade='all, delete-orphan',
                                   back_populates='product')
 
 
+# Serves the prefix matches of the typeahead search (lower(name) LIKE 'x%')
+Index('ix_products_lower_name', func.lower(Product.name).label('lower_name'),
+      postgresql_ops={'lower_name': 'varchar_pattern_ops'})
+
+
 class Specification(Base):
     __tablename__ = 'specifications'
     __table_args__ = (
@@ -60,7 +157,8 @@ class Specification(Base):
             'product_id', 'manufacturer', 'catalog_number',
             name='unique_specification'),)
     # Columns
-    product_id = Column(Integer, ForeignKey('products.id'), nullable=False)
+    product_id = Column(Integer, ForeignKey('products.id'), nullable=False,
+                        index=True)
     manufacturer = Column(String(255), nullable=True)
     catalog_number = Column(String(255), nullable=True)
     units = Column(Integer, default=1, nullable=False)
@@ -68,6 +166,106 @@ class Specification(Base):
     product = relationship('Product', back_populates='specifications')
 
 
+# Serve the prefix matches of the specification typeahead
+Index('ix_specifications_lower_manufacturer',
+      func.lower(Specification.manufacturer).label('lower_manufacturer'),
+      postgresql_ops={'lower_manufacturer': 'varchar_pattern_ops'})
+Index('ix_specifications_lower_catalog_number',
+      func.lower(Specification.catalog_number).label('lower_catalog_number'),
+      postgresql_ops={'lower_catalog_number': 'varchar_pattern_ops'})
+
+
+# Full-text search over products. Accents are removed with translate(), as
+# the unaccent extension is not always available, words are split on any
+# non alphanumeric character, as the searched text is, and stemmed with the
+# portuguese configuration. Specifications are only indexed through their
+# product, whose vector is refreshed by statement-level triggers when they
+# change.
+PRODUCT_SEARCH_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION sms_unaccent(text) RETURNS text
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT translate(
+            $1,
+            'áàâãäéèêëíìîïóòôõöúùûüçñÁÀÂÃÄÉÈÊËÍÌÎÏÓÒÔÕÖÚÙÛÜÇÑ',
+            'aaaaaeeeeiiiiooooouuuucnAAAAAEEEEIIIIOOOOOUUUUCN')
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION sms_search_words(text) RETURNS text
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT regexp_replace(sms_unaccent(coalesce($1, '')),
+                              '[^[:alnum:]]+', ' ', 'g')
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION products_search_vector(
+        product_id integer, name text) RETURNS tsvector
+    LANGUAGE sql STABLE AS $$
+        SELECT setweight(to_tsvector('portuguese', sms_search_words(name)),
+                         'A')
+            || setweight(to_tsvector('portuguese', sms_search_words(
+                string_agg(concat_ws(' ', s.manufacturer, s.catalog_number),
+                           ' '))), 'B')
+        FROM specifications s WHERE s.product_id = $1
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION products_search_vector_trigger()
+    RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.search_vector := products_search_vector(NEW.id, NEW.name);
+        RETURN NEW;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION specifications_search_vector_trigger()
+    RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE products p
+        SET search_vector = products_search_vector(p.id, p.name)
+        WHERE p.id IN (SELECT product_id FROM changed_specifications);
+        IF TG_OP = 'UPDATE' THEN
+            UPDATE products p
+            SET search_vector = products_search_vector(p.id, p.name)
+            WHERE p.id IN (SELECT product_id FROM previous_specifications);
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE TRIGGER products_search_vector
+    BEFORE INSERT OR UPDATE OF name ON products
+    FOR EACH ROW EXECUTE PROCEDURE products_search_vector_trigger()
+    """,
+    """
+    CREATE TRIGGER specifications_search_vector_insert
+    AFTER INSERT ON specifications
+    REFERENCING NEW TABLE AS changed_specifications
+    FOR EACH STATEMENT EXECUTE PROCEDURE specifications_search_vector_trigger()
+    """,
+    """
+    CREATE TRIGGER specifications_search_vector_update
+    AFTER UPDATE ON specifications
+    REFERENCING OLD TABLE AS previous_specifications
+                NEW TABLE AS changed_specifications
+    FOR EACH STATEMENT EXECUTE PROCEDURE specifications_search_vector_trigger()
+    """,
+    """
+    CREATE TRIGGER specifications_search_vector_delete
+    AFTER DELETE ON specifications
+    REFERENCING OLD TABLE AS changed_specifications
+    FOR EACH STATEMENT EXECUTE PROCEDURE specifications_search_vector_trigger()
+    """,
+]
+
+# The functions read specifications, so everything is created after it
+for statement in PRODUCT_SEARCH_DDL:
+    event.listen(Specification.__table__, 'after_create', DDL(statement))
+
+
 class Stock(Base):
     __tablename__ = 'stocks'
     # Columns
@@ -84,18 +282,26 @@ class Stock(Base):
             stock = Stock(name='main').create()
 
     def total(self, product):
-        total = 0
-        for sp in self.stock_products:
-            if sp.product_id == product.id:
-                total += sp.amount
-        return total
-
-    def get_in_stock(self, product, lot_number):
-        for stock_product in self.stock_products:
-            if stock_product.product == product \
-                    and stock_product.lot_number == lot_number:
-                return stock_product
-        return None
+        return db.session.query(
+            func.coalesce(func.sum(StockProduct.amount), 0)).filter(
+            StockProduct.stock_id == self.id,
+            StockProduct.product_id == product.id).scalar()
+
+    def get_in_stock(self, product, lot_number, for_update=False):
+        """
+        Resolve a lot through the `unique_stock_product` index instead of
+        scanning `stock_products`.
+
+        for_update: lock the row until the end of the current transaction
+        and refresh it with the latest committed values
+        """
+        if product.id is None and product not in db.session:
+            return None
+        query = StockProduct.query.filter_by(
+            stock=self, product=product, lot_number=lot_number)
+        if for_update:
+            query = query.with_for_update().populate_existing()
+        return query.first()
 
     def has_enough(self, product, lot_number, amount):
         if amount < 1:
@@ -115,7 +321,7 @@ class Stock(Base):
                 product=product,
                 lot_number=lot_number,
                 expiration_date=expiration_date,
-                amount=0    )
+                amount=0)
         else:
             if expiration_date != stock_product.expiration_date:
                 logger.warning('Different expiration date, updating...')
@@ -123,31 +329,115 @@ class Stock(Base):
         stock_product.amount += amount
         db.session.add(stock_product)
 
+    def add_many(self, items):
+        """
+        items: iterable of (product_id, lot_number, expiration_date, amount)
+
+        Merge every item into `stock_products` with a single
+        INSERT ... ON CONFLICT DO UPDATE. Items repeating a lot are summed
+        first, the last expiration date wins (same as successive `add`s).
+        """
+        merged = OrderedDict()
+        for product_id, lot_number, expiration_date, amount in items:
+            if amount < 1 or isinstance(amount, int) is False:
+                raise ValueError('Amount must be a positive integer')
+            key = (product_id, lot_number)
+            if key in merged:
+                merged[key]['amount'] += amount
+                merged[key]['expiration_date'] = expiration_date
+            else:
+                merged[key] = {
+                    'stock_id': self.id,
+                    'product_id': product_id,
+                    'lot_number': lot_number,
+                    'expiration_date': expiration_date,
+                    'amount': amount,
+                }
+        if not merged:
+            return
+        table = StockProduct.__table__
+        statement = insert(table).values(list(merged.values()))
+        statement = statement.on_conflict_do_update(
+            constraint='unique_stock_product',
+            set_={
+                'amount': table.c.amount + statement.excluded.amount,
+                'expiration_date': statement.excluded.expiration_date,
+            })
+        db.session.flush()
+        db.session.execute(statement)
+        # Lots loaded in the session may now hold stale amounts
+        for obj in list(db.session.identity_map.values()):
+            if isinstance(obj, StockProduct):
+                db.session.expire(obj)
+        db.session.expire(self, ['stock_products'])
+
     def subtract(self, product, lot_number, amount):
         """
         amount: total units to be subtracted
+
+        The lot row stays locked until the caller commits or rolls back,
+        so concurrent subtractions of the same lot are serialized.
         """
         if amount < 1 or isinstance(amount, int) is False:
             raise ValueError('Amount must be a positive integer')
-        in_stock = self.get_in_stock(product, lot_number)
+        in_stock = self.get_in_stock(product, lot_number, for_update=True)
         if in_stock is None:
             raise ValueError('There is no {} in stock'.format(product.name))
-        if self.has_enough(product, lot_number, amount):
+        if in_stock.amount >= amount:
             in_stock.amount -= amount
             return True
         raise ValueError('Not enough in stock')
 
+    def subtract_fefo(self, product, amount):
+        """
+        amount: total units to be subtracted, taken first-expired-first-out
+        across the lots of `product`
+
+        Returns a list of (lot_number, units taken). The candidate lots stay
+        locked until the caller commits or rolls back.
+        """
+        if amount < 1 or isinstance(amount, int) is False:
+            raise ValueError('Amount must be a positive integer')
+        lots = StockProduct.query.filter(
+            StockProduct.stock_id == self.id,
+            StockProduct.product_id == product.id,
+            StockProduct.amount > 0,
+        ).order_by(
+            StockProduct.expiration_date.asc().nullslast(),
+            StockProduct.id,
+        ).with_for_update().populate_existing().all()
+        if not lots:
+            raise ValueError('There is no {} in stock'.format(product.name))
+        if sum(lot.amount for lot in lots) < amount:
+            raise ValueError('Not enough in stock')
+        taken = []
+        remaining = amount
+        for lot in lots:
+            if remaining == 0:
+                break
+            units = min(lot.amount, remaining)
+            lot.amount -= units
+            remaining -= units
+            taken.append((lot.lot_number, units))
+        return taken
+
 
 class StockProduct(Base):
     __tablename__ = 'stock_products'
-    __table_args__ = (UniqueConstraint(
-        'stock_id', 'product_id', 'lot_number',
-        name='unique_stock_product'),)
+    query_class = StockProductQuery
+    __table_args__ = (
+        UniqueConstraint(
+            'stock_id', 'product_id', 'lot_number',
+            name='unique_stock_product'),
+        # Serves Stock.subtract_fefo, ordered by expiration_date NULLS LAST
+        # (the btree default) then id
+        Index('ix_stock_products_fefo',
+              'stock_id', 'product_id', 'expiration_date', 'id'),)
     # Columns
     stock_id = Column(Integer, ForeignKey('stocks.id'), nullable=False)
     product_id = Column(Integer, ForeignKey('products.id'), nullable=False)
     lot_number = Column(String(255), nullable=False)
-    expiration_date = Column(Date, nullable=True)
+    expiration_date = Column(Date, nullable=True, index=True)
     amount = Column(Integer, default=0, nullable=False)
     # Relationships
     stock = relationship('Stock', back_populates='stock_products')
@@ -158,6 +448,10 @@ class StockProduct(Base):
 
 class Order(Base, TimeStampedModelMixin):
     __tablename__ = 'orders'
+    query_class = OrderQuery
+    __table_args__ = (
+        Index('ix_orders_order_date_id', 'order_date', 'id'),
+        Index('ix_orders_updated_on_id', 'updated_on', 'id'),)
     # Columns
     user_id = Column(Integer, ForeignKey(
         'users.id', ondelete='SET NULL'), nullable=True)
@@ -178,6 +472,8 @@ class OrderItem(Base):
     # any advantages
     # __table_args__ = (UniqueConstraint(
     #     'item_id', 'order_id', 'lot_number', name='unique_order_item'), )
+    __table_args__ = (
+        Index('ix_order_items_lot_number_item_id', 'lot_number', 'item_id'),)
     # Columns
     # TODO: rename it to specification_id
     item_id = Column(Integer, ForeignKey(
@@ -197,6 +493,79 @@ class OrderItem(Base):
                                          cascade='all, delete-orphan'))
 
 
+class CartItem(Base):
+    """Line of the order a user is assembling, see services.get_cart"""
+    __tablename__ = 'cart_items'
+    # Columns
+    user_id = Column(Integer, ForeignKey(
+        'users.id', ondelete='CASCADE'), nullable=False, index=True)
+    specification_id = Column(Integer, ForeignKey(
+        'specifications.id', ondelete='CASCADE'), nullable=False)
+    amount = Column(Integer, nullable=False)
+    lot_number = Column(String(255), nullable=False)
+    expiration_date = Column(Date, nullable=True)
+
+
+class StockAlert(Base):
+    """
+    Product of a stock that fell below its minimum, kept while it stays
+    there. See services.evaluate_stock_alerts.
+    """
+    __tablename__ = 'stock_alerts'
+    __table_args__ = (
+        UniqueConstraint('stock_id', 'product_id',
+                         name='unique_stock_alert'),)
+    # Columns
+    stock_id = Column(Integer, ForeignKey(
+        'stocks.id', ondelete='CASCADE'), nullable=False)
+    product_id = Column(Integer, ForeignKey(
+        'products.id', ondelete='CASCADE'), nullable=False)
+    # Units in stock when last evaluated
+    amount = Column(Integer, nullable=False)
+    stock_minimum = Column(Integer, nullable=False)
+    created_on = Column(DateTime, default=datetime.utcnow, nullable=False)
+    # When it was included in a digest
+    sent_on = Column(DateTime, nullable=True)
+    # Relationships
+    product = relationship('Product')
+
+
+class OutboxEmail(Base):
+    """
+    Email waiting to be delivered by `flask mail-worker`. Rows are kept
+    after delivery, with `sent_on` set. See app.utils.email.
+    """
+    __tablename__ = 'outbox_emails'
+    # Columns
+    sender = Column(String(255))
+    # Comma separated
+    recipients = Column(Text, nullable=False)
+    subject = Column(Text, nullable=False)
+    body = Column(Text)
+    html = Column(Text)
+    created_on = Column(DateTime, default=datetime.utcnow)
+    next_attempt_on = Column(DateTime, default=datetime.utcnow,
+                             nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(Text)
+    sent_on = Column(DateTime)
+
+    def record_failure(self, error, retry_delay):
+        """
+        Schedule the next attempt `retry_delay` seconds later, doubling the
+        delay at each failure
+        """
+        self.attempts += 1
+        self.last_error = str(error)
+        self.next_attempt_on = datetime.utcnow() + timedelta(
+            seconds=retry_delay * 2 ** (self.attempts - 1))
+
+
+# Only unsent emails are looked up by the worker
+Index('ix_outbox_emails_next_attempt_on', OutboxEmail.next_attempt_on,
+      postgresql_where=OutboxEmail.sent_on.is_(None))
+
+
 # TODO: refactor Transaction
 # - Add OrderItem dependency (1 to 1, uselist=False)
 # - Add StockProduct dependency (many to one)
@@ -204,6 +573,7 @@ class OrderItem(Base):
 # TODO: Define cascade rules after refactoring
 class Transaction(Base, TimeStampedModelMixin):
     __tablename__ = 'transactions'
+    query_class = TransactionQuery
     # Columns
     user_id = Column(Integer, ForeignKey(
         'users.id', ondelete='SET NULL'), nullable=True)
@@ -220,7 +590,48 @@ class Transaction(Base, TimeStampedModelMixin):
     stock = relationship('Stock')
     # Constraints
     __table_args__ = (
-        CheckConstraint(amount > 0, name='amount_is_positive'), {})
+        CheckConstraint(amount > 0, name='amount_is_positive'),
+        Index('ix_transactions_updated_on_id', 'updated_on', 'id'), {})
     # Attributes
     ADD = 1
     SUB = 2
+
+
+class DataChange(Base):
+    """
+    Row added by the data_change triggers for every statement that writes
+    to a table read by the exports. The rows of a table are only counted:
+    the count changes with every committed write, in whatever order the
+    writes commit. See utils.get_data_version.
+    """
+    __tablename__ = 'data_changes'
+    # Columns
+    table_name = Column(String(64), nullable=False, index=True)
+
+
+# Tables whose writes are recorded in data_changes
+DATA_CHANGE_TABLES = ['orders', 'products', 'specifications',
+                      'stock_products', 'stocks', 'transactions', 'users']
+
+DATA_CHANGE_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION data_change_trigger()
+    RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO data_changes (table_name) VALUES (TG_TABLE_NAME);
+        RETURN NULL;
+    END
+    $$
+    """,
+] + [
+    """
+    CREATE TRIGGER {0}_data_change
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {0}
+    FOR EACH STATEMENT EXECUTE PROCEDURE data_change_trigger()
+    """.format(table_name) for table_name in DATA_CHANGE_TABLES
+]
+
+# users is defined in app.auth.models, so the triggers are created once
+# every table exists
+for statement in DATA_CHANGE_DDL:
+    event.listen(db.metadata, 'after_create', DDL(statement))
@@ -0,0 +1,365 @@
+"""
+Synthetic inventories for local development, see the `seed` command.
+
+Everything is drawn from a random.Random(seed) so the same options produce
+the same data, and written with COPY in a single transaction.
+"""
+import io
+import math
+import random
+import string
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import accumulate, chain
+
+from sqlalchemy import text
+from werkzeug.security import generate_password_hash
+
+from app.extensions import db
+from app.auth.models import Role
+from app.main.models import Stock, Transaction
+
+
+SEED_PASSWORD = 'password'
+SEEDED_TABLES = ['users', 'products', 'specifications', 'orders',
+                 'order_items', 'stock_products', 'transactions']
+COPY_CHUNK_SIZE = 100000
+
+ANIONS = ['Cloreto', 'Sulfato', 'Nitrato', 'Fosfato', 'Acetato',
+          'Carbonato', 'Bicarbonato', 'Hidróxido', 'Brometo', 'Iodeto',
+          'Citrato', 'Óxido', 'Permanganato', 'Tiossulfato', 'Cromato',
+          'Oxalato', 'Fluoreto', 'Borato']
+CATIONS = ['de sódio', 'de potássio', 'de cálcio', 'de magnésio',
+           'de amônio', 'de cobre', 'de zinco', 'de ferro', 'de bário',
+           'de lítio', 'de prata', 'de alumínio', 'de manganês',
+           'de cobalto', 'de níquel', 'de estrôncio']
+ORGANICS = ['Ácido acético', 'Ácido clorídrico', 'Ácido sulfúrico',
+            'Ácido nítrico', 'Ácido fosfórico', 'Ácido cítrico',
+            'Ácido bórico', 'Etanol', 'Metanol', 'Isopropanol', 'Acetona',
+            'Clorofórmio', 'Hexano', 'Tolueno', 'Xilol', 'Formaldeído',
+            'Glicerol', 'Glicina', 'Tris base', 'Agarose', 'Ágar',
+            'Dodecil sulfato de sódio', 'EDTA dissódico', 'Glicose',
+            'Sacarose', 'Ureia', 'Fenol', 'Éter etílico',
+            'Dimetilsulfóxido', 'Acetonitrila', 'Tampão fosfato',
+            'Azul de metileno', 'Cristal violeta', 'Safranina', 'Eosina',
+            'Hematoxilina', 'Lugol', 'Ninidrina', 'Brometo de etídio',
+            'Peptona', 'Extrato de levedura']
+GRADES = ['P.A.', 'P.A.-A.C.S.', 'anidro', 'hidratado', 'HPLC', '99%',
+          'USP', 'técnico', 'para biologia molecular', 'UV/HPLC']
+MANUFACTURERS = ['Sigma-Aldrich', 'Merck', 'Vetec', 'Synth', 'Dinâmica',
+                 'Neon', 'Isofar', 'Nuclear', 'Qhemis', 'Cromoline',
+                 'Thermo Fisher', 'Invitrogen', 'Honeywell', 'Alphatec']
+UNITS = [1, 1, 1, 1, 2, 5, 6, 10, 12, 25]
+STOCK_MINIMUMS = [1, 1, 2, 2, 3, 5, 5, 10, 20, 50]
+INVOICE_TYPES = ['Não informado', 'Nota Fiscal', 'Nota Fiscal',
+                 'Nota Fiscal', 'Nota de Fornecimento (FIOCRUZ)',
+                 'Nota de Fornecimento (Ministério da Saúde)', 'Outros']
+FINANCIERS = ['FAPERJ', 'CNPq', 'CAPES', 'FIOCRUZ', 'Ministério da Saúde',
+              None, None]
+# Share of the users holding each role
+ROLE_SHARES = [('User', 70), ('Staff', 25), ('Administrator', 5)]
+
+
+def product_names(rng, count, existing):
+    """`count` reagent names, none of them in `existing`"""
+    bases = ['{} {}'.format(anion, cation)
+             for anion in ANIONS for cation in CATIONS] + ORGANICS
+    candidates = ['{} {}'.format(base, grade)
+                  for base in bases for grade in GRADES]
+    rng.shuffle(candidates)
+    names = []
+    suffix = 1
+    while len(names) < count:
+        for candidate in candidates:
+            name = candidate if suffix == 1 else '{} {}'.format(
+                candidate, suffix)
+            if name not in existing:
+                names.append(name)
+                if len(names) == count:
+                    break
+        suffix += 1
+    return names
+
+
+def zipf_weights(rng, count, exponent=1.0):
+    """Weights of a shuffled Zipf popularity distribution"""
+    weights = [1 / rank ** exponent for rank in range(1, count + 1)]
+    rng.shuffle(weights)
+    return weights
+
+
+def lot_number(rng, number):
+    return '{}{}{:05d}'.format(rng.choice(string.ascii_uppercase),
+                               rng.choice(string.ascii_uppercase), number)
+
+
+# Characters with a meaning in the COPY text format
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_value(value):
+    return r'\N' if value is None else str(value).translate(COPY_ESCAPES)
+
+
+def copy_rows(cursor, table, columns, rows):
+    """COPY `rows` into `table`, return how many were written"""
+    statement = 'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns))
+    count = 0
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(copy_value(value) for value in row))
+        buffer.write('\n')
+        count += 1
+        if count % COPY_CHUNK_SIZE == 0:
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+            buffer = io.StringIO()
+    buffer.seek(0)
+    cursor.copy_expert(statement, buffer)
+    return count
+
+
+@contextmanager
+def foreign_keys_dropped(connection, tables):
+    """
+    Drop the foreign keys of `tables` and add them back on exit. Adding a
+    key checks every row in one join, much faster than the row by row
+    checks made while copying.
+    """
+    foreign_keys = connection.execute(text(
+        "SELECT conrelid::regclass::text, conname, "
+        "pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE contype = 'f' AND conrelid::regclass::text = ANY(:tables)"),
+        tables=list(tables)).fetchall()
+    for table, name, _ in foreign_keys:
+        connection.execute(text(
+            'ALTER TABLE {} DROP CONSTRAINT {}'.format(table, name)))
+    yield
+    for table, name, definition in foreign_keys:
+        connection.execute(text('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(
+            table, name, definition)))
+
+
+def next_ids(connection, tables):
+    return {table: connection.execute(text(
+        'SELECT coalesce(max(id), 0) + 1 FROM {}'.format(table))).scalar()
+        for table in tables}
+
+
+class InventorySeeder:
+    """
+    Writes each part of a synthetic inventory with COPY, on the connection
+    of the current session. Ids follow the largest existing ones.
+    """
+
+    def __init__(self, rng, months, progress=None):
+        self.rng = rng
+        self.progress = progress
+        self.connection = db.session.connection()
+        self.cursor = self.connection.connection.cursor()
+        self.ids = next_ids(self.connection, SEEDED_TABLES)
+        self.stock_id = Stock.query.first().id
+        # Whole days, so the same seed always gives the same dates relative
+        # to today
+        self.end = datetime.combine(datetime.utcnow().date(),
+                                    datetime.min.time())
+        self.start = self.end - timedelta(days=30 * months)
+        self.period = (self.end - self.start).total_seconds()
+        self.counts = OrderedDict()
+
+    def write(self, table, columns, rows):
+        self.counts[table] = copy_rows(self.cursor, table, columns, rows)
+        if self.progress:
+            self.progress(table, self.counts[table])
+
+    def users(self, count):
+        """Return the ids of the users and of those who may edit"""
+        rng = self.rng
+        role_ids = dict(db.session.query(Role.name, Role.id))
+        password_hash = generate_password_hash(SEED_PASSWORD)
+        roles = rng.choices([name for name, _ in ROLE_SHARES],
+                            [share for _, share in ROLE_SHARES], k=count)
+        user_ids = list(range(self.ids['users'], self.ids['users'] + count))
+        self.write('users', ['id', 'email', 'password_hash', 'confirmed',
+                             'stock_mail_alert', 'role_id'],
+                   ((user_id, 'usuario{}@example.com'.format(user_id),
+                     password_hash, rng.random() < 0.95,
+                     # Seeded addresses can not receive the alerts
+                     False, role_ids[role])
+                    for user_id, role in zip(user_ids, roles)))
+        staff_ids = [user_id for user_id, role in zip(user_ids, roles)
+                     if role != 'User']
+        return user_ids, staff_ids or user_ids
+
+    def catalog(self, count):
+        """Return the product ids and the specifications of each one"""
+        rng = self.rng
+        existing = {name for name, in self.connection.execute(
+            text('SELECT name FROM products'))}
+        product_ids = list(range(self.ids['products'],
+                                 self.ids['products'] + count))
+        self.write('products', ['id', 'name', 'stock_minimum'],
+                   ((product_id, name, rng.choice(STOCK_MINIMUMS))
+                    for product_id, name in zip(
+                        product_ids, product_names(rng, count, existing))))
+        # {product id: [(id, product id, manufacturer, catalog number,
+        #                units)]}
+        specifications = OrderedDict()
+        specification_id = self.ids['specifications']
+        for product_id in product_ids:
+            specifications[product_id] = []
+            for manufacturer in rng.sample(
+                    MANUFACTURERS, 1 + min(int(rng.expovariate(1.5)), 3)):
+                specifications[product_id].append((
+                    specification_id, product_id, manufacturer,
+                    '{}{}'.format(manufacturer[0], rng.randint(1000, 99999)),
+                    rng.choice(UNITS)))
+                specification_id += 1
+        self.write('specifications', ['id', 'product_id', 'manufacturer',
+                                      'catalog_number', 'units'],
+                   chain.from_iterable(specifications.values()))
+        return product_ids, specifications
+
+    def orders(self, count, staff_ids):
+        """Return the (date, user id) of each order, oldest first"""
+        rng = self.rng
+        orders = [(self.start + timedelta(
+            seconds=rng.uniform(0, self.period)), rng.choice(staff_ids))
+            for _ in range(count)]
+        orders.sort()
+        self.write('orders', ['id', 'created_on', 'updated_on', 'user_id',
+                              'invoice', 'invoice_type', 'invoice_value',
+                              'financier', 'notes', 'order_date'],
+                   ((order_id, order_date, order_date, user_id,
+                     str(rng.randint(1000, 999999)),
+                     rng.choice(INVOICE_TYPES),
+                     round(rng.lognormvariate(7, 1), 2),
+                     rng.choice(FINANCIERS), None, order_date)
+                    for order_id, (order_date, user_id) in enumerate(
+                        orders, self.ids['orders'])))
+        return orders
+
+    def lots(self, orders, product_ids, specifications, consumptions,
+             user_ids):
+        """
+        Receive a few lots in each order and spread `consumptions` SUB
+        transactions over them, popular products (Zipf distributed) being
+        received and consumed more often. Writes the order items, the
+        stock products and the transactions.
+        """
+        rng = self.rng
+        product_cum_weights = list(accumulate(
+            zipf_weights(rng, len(product_ids))))
+        # (order index, product index, specification, lot number,
+        #  expiration date)
+        lots = []
+        for order_index, (order_date, _) in enumerate(orders):
+            for product_index in rng.choices(
+                    range(len(product_ids)), cum_weights=product_cum_weights,
+                    k=1 + min(int(rng.expovariate(1 / 3)), 14)):
+                lots.append((
+                    order_index, product_index,
+                    rng.choice(specifications[product_ids[product_index]]),
+                    lot_number(rng, self.ids['order_items'] + len(lots)),
+                    (order_date + timedelta(
+                        days=rng.randint(180, 1800))).date()))
+        # Popular products already have more lots to be consumed from
+        consumptions_per_lot = [0] * len(lots)
+        if lots:
+            for lot_index in rng.choices(range(len(lots)), k=consumptions):
+                consumptions_per_lot[lot_index] += 1
+
+        # (seconds since start, user id, product id, lot number, amount,
+        #  category)
+        ledger = []
+        order_items = []
+        stock_products = []
+        for index, (order_index, _, specification, lot, expiration_date) \
+                in enumerate(lots):
+            order_date, order_user_id = orders[order_index]
+            received_on = (order_date - self.start).total_seconds()
+            # Consumed between the reception and the expiration of the lot
+            consumed_until = min(self.period, (datetime.combine(
+                expiration_date, datetime.min.time()) -
+                self.start).total_seconds())
+            specification_id, product_id, _, _, units = specification
+            consumed = 0
+            for _ in range(consumptions_per_lot[index]):
+                amount = 1 + int(rng.expovariate(0.5))
+                consumed += amount
+                ledger.append((rng.uniform(received_on, consumed_until),
+                               rng.choice(user_ids), product_id, lot, amount,
+                               Transaction.SUB))
+            # Most lots are used up, some are left over
+            left = rng.randint(0, max(2, consumed // 3)) \
+                if rng.random() < 0.4 or not consumed else 0
+            amount = max(1, math.ceil((consumed + left) / units))
+            order_items.append((self.ids['order_items'] + index,
+                                specification_id,
+                                self.ids['orders'] + order_index, amount, lot,
+                                expiration_date, True))
+            stock_products.append((self.ids['stock_products'] + index,
+                                   self.stock_id, product_id, lot,
+                                   expiration_date, amount * units - consumed))
+            ledger.append((received_on, order_user_id, product_id, lot,
+                           amount * units, Transaction.ADD))
+        self.write('order_items', ['id', 'item_id', 'order_id', 'amount',
+                                   'lot_number', 'expiration_date',
+                                   'added_to_stock'], order_items)
+        self.write('stock_products', ['id', 'stock_id', 'product_id',
+                                      'lot_number', 'expiration_date',
+                                      'amount'], stock_products)
+
+        # Inserted in time order, like the real ledger
+        ledger.sort()
+
+        def transaction_rows():
+            for transaction_id, (seconds, user_id, product_id, lot, amount,
+                                 category) in enumerate(
+                    ledger, self.ids['transactions']):
+                created_on = self.start + timedelta(seconds=seconds)
+                yield (transaction_id, created_on, created_on, user_id,
+                       product_id, self.stock_id, lot, amount, category)
+
+        self.write('transactions', ['id', 'created_on', 'updated_on',
+                                    'user_id', 'product_id', 'stock_id',
+                                    'lot_number', 'amount', 'category'],
+                   transaction_rows())
+
+    def reset_sequences(self):
+        for table in self.ids:
+            self.connection.execute(text(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                "(SELECT max(id) FROM {0}))".format(table)))
+
+
+def seed(products=2000, users=50, orders=5000, transactions=100000,
+         months=24, random_seed=0, progress=None):
+    """
+    Insert a synthetic inventory into the database and commit it:
+
+    - `users` users, most with the User role, sharing SEED_PASSWORD
+    - `products` products with 1 to 4 specifications each
+    - `orders` orders spread over the last `months` months, each receiving
+      a few lots into the main stock, with their ADD transactions
+    - `transactions` SUB transactions consuming those lots
+
+    The resulting stock_products amounts match the ledger. Existing rows
+    are kept. Returns an OrderedDict of the rows inserted per table.
+
+    progress: optional callable receiving (table, rows) after each table
+    """
+    Role.insert_roles()
+    Stock.insert_main_stock()
+    seeder = InventorySeeder(random.Random(random_seed), months, progress)
+    with foreign_keys_dropped(seeder.connection, SEEDED_TABLES):
+        user_ids, staff_ids = seeder.users(users)
+        product_ids, specifications = seeder.catalog(products)
+        seeded_orders = seeder.orders(orders, staff_ids)
+        seeder.lots(seeded_orders, product_ids, specifications,
+                    transactions, user_ids)
+    seeder.reset_sequences()
+    db.session.commit()
+    return seeder.counts
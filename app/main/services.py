@@ -1,10 +1,19 @@
-import jsonpickle
-from flask import session
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import groupby, islice
+
+from flask import current_app, g
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import joinedload, contains_eager
 
 from app.extensions import db
-from app.main.models import (Stock, StockProduct, Product,
-                             Order, OrderItem, Specification, Transaction)
+from app.main.models import (Stock, StockProduct, Product, Order, OrderItem,
+                             Specification, Transaction, CartItem,
+                             StockAlert)
 from app.auth.models import User
+from app.utils.email import send_email
 
 
 def get_stock(stock_id=None):
@@ -15,38 +24,526 @@ def get_stock(stock_id=None):
 
 
 def get_products_in_stock(stock):
-    products = db.session.query(Product).join(StockProduct).filter_by(
-        stock_id=stock.id).order_by(Product.name).all()
-    for p in products:
-        p.total = stock.total(p)
+    """
+    Return the products held in `stock`, ordered by name, each one
+    annotated with `total` (sum of its lots), `below_minimum` and `lots`,
+    its lots in `stock` with units left, first to expire first.
+    Totals are computed by the database in a single grouped query, and
+    the lots are read with one more query.
+    """
+    total = func.sum(StockProduct.amount).label('total')
+    rows = db.session.query(Product, total).join(StockProduct).filter(
+        StockProduct.stock_id == stock.id).group_by(Product.id).order_by(
+        Product.name).all()
+    lots = db.session.query(
+        StockProduct.product_id, StockProduct.lot_number,
+        StockProduct.expiration_date, StockProduct.amount).filter(
+        StockProduct.stock_id == stock.id, StockProduct.amount > 0).order_by(
+        StockProduct.product_id,
+        StockProduct.expiration_date.asc().nullslast(), StockProduct.id)
+    lots_by_product = {
+        product_id: list(product_lots)
+        for product_id, product_lots in groupby(lots, lambda lot: lot[0])}
+    products = []
+    for product, product_total in rows:
+        product.total = product_total
+        product.below_minimum = product_total < product.stock_minimum
+        product.lots = lots_by_product.get(product.id, [])
+        products.append(product)
     return products
 
+
+def get_manufacturers_by_lot_number(lot_numbers):
+    """
+    Map each lot number to the manufacturer of the first specification
+    received with it ('' when unknown), resolving all lots in one query.
+    Results are cached for the rest of the request.
+    """
+    lot_numbers = list(lot_numbers)
+    cache = g.setdefault('manufacturers_by_lot_number', {})
+    missing = set(lot_numbers).difference(cache)
+    if missing:
+        rows = db.session.query(
+            OrderItem.lot_number, Specification.manufacturer).join(
+            Specification, OrderItem.item).filter(
+            OrderItem.lot_number.in_(missing)).distinct(
+            OrderItem.lot_number).order_by(
+            OrderItem.lot_number, OrderItem.id).all()
+        cache.update(dict.fromkeys(missing, ''))
+        for lot_number, manufacturer in rows:
+            cache[lot_number] = manufacturer or ''
+    return {lot_number: cache[lot_number] for lot_number in lot_numbers}
+
+
 def get_manufacturer_by_lot_number(lot_number):
-    spec = db.session.query(Specification).join(OrderItem).filter_by(
-        lot_number=lot_number
-    ).first()
-    return spec.manufacturer or ''
+    return get_manufacturers_by_lot_number([lot_number])[lot_number]
 
 
 def get_specifications():
     return db.session.query(Specification).join(Product).order_by(
         Product.name).all()
 
-def create_add_transactions_from_order(order, stock):
-    user = order.user
-    for order_item in order.order_items:
-        product = order_item.item.product
-        lot_number = order_item.lot_number
-        total_units = order_item.amount * order_item.item.units
-        transaction = Transaction()
-        transaction.user = user
-        transaction.product = product
-        transaction.lot_number = lot_number
-        transaction.amount = total_units
-        transaction.stock = stock
-        transaction.category = Transaction.ADD
-        db.session.add(transaction)
+
+# Typeahead search. Every search returns up to `limit` (id, label) pairs,
+# the ones starting with the searched text first, then the ones containing
+# it.
+
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+
+def escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_query(query, columns, text, limit=SEARCH_LIMIT):
+    """
+    Rows of `query` where any of `columns` starts with `text`, then the ones
+    where any of them contains it. Matching ignores case and the prefix
+    matches can use indexes on lower(column).
+    """
+    pattern = escape_like(text.strip().lower())
+    starts_with = db.or_(*(func.lower(column).like(pattern + '%')
+                           for column in columns))
+    rows = query.filter(starts_with).limit(limit).all()
+    if pattern and len(rows) < limit:
+        contains = db.or_(*(func.lower(column).like('%' + pattern + '%')
+                            for column in columns))
+        rows += query.filter(contains, db.not_(starts_with)).limit(
+            limit - len(rows)).all()
+    return rows
+
+
+def specification_label(specification):
+    return '{} | {} | Catálogo: {} | {} unidades/produto'.format(
+        specification.product.name, specification.manufacturer,
+        specification.catalog_number, specification.units)
+
+
+def product_in_stock_label(product, total):
+    return f'{product.name} | Quantidade: {total}'
+
+
+def stock_product_label(stock_product, manufacturer):
+    return (f'{stock_product.product.name}'
+            f' | Lote: {stock_product.lot_number}'
+            f' | Validade: {stock_product.expiration_date:%d-%m-%y}'
+            f' | Quantidade: {stock_product.amount}'
+            f' | Fabricante: {manufacturer}')
+
+
+def search_products(text, limit=SEARCH_LIMIT):
+    products = search_query(Product.query.order_by(Product.name),
+                            [Product.name], text, limit)
+    return [(product.id, product.name) for product in products]
+
+
+def search_catalog(text, limit=SEARCH_LIMIT):
+    """
+    Products whose name, manufacturers or catalog numbers have words
+    starting with every word of `text`, best ranked first. Accents and
+    Portuguese inflections are ignored, see PRODUCT_SEARCH_DDL.
+    """
+    words = re.findall(r'[^\W_]+', text)
+    if not words:
+        return search_products('', limit)
+    query = func.to_tsquery('portuguese', func.sms_unaccent(
+        ' & '.join(word + ':*' for word in words)))
+    rank = func.ts_rank(Product.search_vector, query)
+    products = db.session.query(Product.id, Product.name).filter(
+        Product.search_vector.op('@@')(query)).order_by(
+        rank.desc(), Product.name).limit(limit)
+    return [(id, name) for id, name in products]
+
+
+def _products_in_stock(stock):
+    total = func.sum(StockProduct.amount).label('total')
+    return db.session.query(Product, total).join(StockProduct).filter(
+        StockProduct.stock_id == stock.id).group_by(Product.id).having(
+        total > 0).order_by(Product.name)
+
+
+def search_products_in_stock(stock, text, limit=SEARCH_LIMIT):
+    rows = search_query(_products_in_stock(stock), [Product.name], text,
+                        limit)
+    return [(product.id, product_in_stock_label(product, total))
+            for product, total in rows]
+
+
+def get_product_in_stock_label(stock, product_id):
+    row = _products_in_stock(stock).filter(Product.id == product_id).first()
+    return product_in_stock_label(*row) if row else None
+
+
+def _specifications_with_products():
+    return Specification.query.join(Specification.product).options(
+        contains_eager(Specification.product))
+
+
+def search_specifications(text, limit=SEARCH_LIMIT):
+    specifications = search_query(
+        _specifications_with_products().order_by(
+            Product.name, Specification.id),
+        [Product.name, Specification.manufacturer,
+         Specification.catalog_number], text, limit)
+    return [(specification.id, specification_label(specification))
+            for specification in specifications]
+
+
+def get_specification_label(specification_id):
+    """Label of a specification, None if it does not exist"""
+    specification = _specifications_with_products().filter(
+        Specification.id == specification_id).first()
+    return specification_label(specification) if specification else None
+
+
+def _stock_products_in_stock(stock):
+    """Lots of `stock` with units left, with their products, by name"""
+    return StockProduct.query.with_display_relations().filter(
+        StockProduct.stock_id == stock.id,
+        StockProduct.amount > 0).order_by(
+        Product.name, StockProduct.expiration_date)
+
+
+def _stock_product_choices(stock_products):
+    manufacturers = get_manufacturers_by_lot_number(
+        sp.lot_number for sp in stock_products)
+    return [(sp.id, stock_product_label(sp, manufacturers[sp.lot_number]))
+            for sp in stock_products]
+
+
+def search_stock_products(stock, text, limit=SEARCH_LIMIT):
+    """Lots of `stock` with units left, by product name or lot number"""
+    stock_products = search_query(
+        _stock_products_in_stock(stock),
+        [Product.name, StockProduct.lot_number], text, limit)
+    return _stock_product_choices(stock_products)
+
+
+def get_stock_product_label(stock, stock_product_id):
+    stock_products = _stock_products_in_stock(stock).filter(
+        StockProduct.id == stock_product_id).all()
+    choices = _stock_product_choices(stock_products)
+    return choices[0][1] if choices else None
+
+
+def search_users(text, limit=SEARCH_LIMIT):
+    users = search_query(User.query.order_by(User.email), [User.email],
+                         text, limit)
+    return [(user.id, user.email) for user in users]
+
+
+def get_user_label(user_id):
+    user = User.query.get(user_id)
+    return user.email if user else None
+
+
+# Business operations. Each one flushes its changes together and commits
+# exactly once; on failure the session is rolled back and the error is
+# re-raised to the caller.
+
+def receive_order(order, stock):
+    """Add the items of `order` to `stock` and record the ADD transactions"""
+    try:
+        db.session.add(order)
+        for order_item in order.order_items:
+            order_item.added_to_stock = True
+        stock.add_many(
+            (order_item.item.product_id,
+             order_item.lot_number,
+             order_item.expiration_date,
+             order_item.amount * order_item.item.units)
+            for order_item in order.order_items)
+        create_add_transactions_from_order(order, stock)
+        evaluate_stock_alerts(stock, [order_item.item.product_id
+                                      for order_item in order.order_items])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return order
+
+
+def consume(stock, product, lot_number, amount, user):
+    """Subtract `amount` units of a lot and record the SUB transaction"""
+    try:
+        stock.subtract(product, lot_number, amount)
+        create_sub_transaction(user, product, lot_number, amount, stock)
+        evaluate_stock_alerts(stock, [product.id])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def consume_fefo(stock, product, amount, user):
+    """
+    Subtract `amount` units of `product` first-expired-first-out and record
+    one SUB transaction per lot touched. Returns [(lot_number, units)].
+    """
+    try:
+        taken = stock.subtract_fefo(product, amount)
+        for lot_number, units in taken:
+            create_sub_transaction(user, product, lot_number, units, stock)
+        evaluate_stock_alerts(stock, [product.id])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return taken
+
+
+def create_product(name):
+    product = Product(name=name)
+    try:
+        db.session.add(product)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return product
+
+
+def create_specification(product_id, manufacturer, catalog_number, units):
+    specification = Specification(
+        product_id=product_id,
+        manufacturer=manufacturer,
+        catalog_number=catalog_number,
+        units=units,
+    )
+    try:
+        db.session.add(specification)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return specification
+
+
+IMPORT_BATCH_SIZE = 1000
+MAX_INTEGER = 2 ** 31 - 1
+
+ImportResult = namedtuple(
+    'ImportResult', ['rows', 'products', 'specifications', 'errors'])
+
+
+def parse_catalog_row(row):
+    """
+    Validate a row of the products export (reativo, fabricante, catalogo,
+    unidade_de_estoque, estoque_minimo) and return
+    (name, stock_minimum, manufacturer, catalog_number, units).
+    Raises ValueError with the reason when the row is invalid.
+    """
+    def text(column, required=False):
+        value = row.get(column)
+        value = str(value).strip() if value is not None else ''
+        if required and not value:
+            raise ValueError(f'{column} is required')
+        if len(value) > 255:
+            raise ValueError(f'{column} is longer than 255 characters')
+        return value or None
+
+    def integer(column, minimum):
+        value = row.get(column)
+        if value is None or str(value).strip() == '':
+            return 1
+        try:
+            number = float(value)
+        except ValueError:
+            raise ValueError(f'{column} is not a number: {value}')
+        # XLSX cells hold whole numbers as floats, such as 2.0
+        if not number.is_integer():
+            raise ValueError(f'{column} is not an integer: {value}')
+        value = int(number)
+        if not minimum <= value <= MAX_INTEGER:
+            raise ValueError(
+                f'{column} must be between {minimum} and {MAX_INTEGER}')
+        return value
+
+    return (text('reativo', required=True),
+            integer('estoque_minimo', 0),
+            text('fabricante'),
+            text('catalogo'),
+            integer('unidade_de_estoque', 1))
+
+
+def import_catalog_batch(rows):
+    """
+    Insert the products and specifications of the parsed `rows` that do not
+    exist yet. Returns the number of (products, specifications) created.
+    """
+    stock_minimums = {}
+    for name, stock_minimum, *_ in rows:
+        stock_minimums.setdefault(name, stock_minimum)
+    # unnest keeps the statement to one parameter per column, a multi-row
+    # VALUES would be compiled with one bind parameter per cell
+    products_created = db.session.execute(
+        'INSERT INTO products (name, stock_minimum) \
+        SELECT * FROM unnest(CAST(:names AS varchar[]), \
+                             CAST(:stock_minimums AS integer[])) \
+        ON CONFLICT (name) DO NOTHING RETURNING id',
+        {'names': list(stock_minimums),
+         'stock_minimums': list(stock_minimums.values())}).rowcount
+    product_ids = dict(db.session.execute(
+        'SELECT name, id FROM products WHERE name = ANY(:names)',
+        {'names': list(stock_minimums)}).fetchall())
+
+    specifications = {}
+    for name, _, manufacturer, catalog_number, units in rows:
+        key = (product_ids[name], manufacturer, catalog_number)
+        specifications.setdefault(key, units)
+    # unique_specification does not catch duplicates holding NULLs, so the
+    # existing specifications are also filtered out here
+    existing = db.session.execute(
+        'SELECT product_id, manufacturer, catalog_number FROM specifications \
+        WHERE product_id = ANY(:product_ids)',
+        {'product_ids': list(product_ids.values())})
+    for key in existing:
+        specifications.pop(tuple(key), None)
+    specifications_created = 0
+    if specifications:
+        columns = list(zip(*(key + (units,) for key, units
+                             in specifications.items())))
+        specifications_created = db.session.execute(
+            'INSERT INTO specifications \
+                (product_id, manufacturer, catalog_number, units) \
+            SELECT * FROM unnest(CAST(:product_ids AS integer[]), \
+                                 CAST(:manufacturers AS varchar[]), \
+                                 CAST(:catalog_numbers AS varchar[]), \
+                                 CAST(:units AS integer[])) \
+            ON CONFLICT ON CONSTRAINT unique_specification DO NOTHING \
+            RETURNING id',
+            dict(zip(['product_ids', 'manufacturers', 'catalog_numbers',
+                      'units'], map(list, columns)))).rowcount
+    return products_created, specifications_created
+
+
+def import_catalog(rows, batch_size=IMPORT_BATCH_SIZE, progress=None):
+    """
+    Bulk import products and specifications from `rows`, dicts keyed by the
+    columns of the products export. Products are matched by name and
+    specifications by (product, manufacturer, catalog number); the existing
+    ones are left untouched.
+
+    Rows are validated and inserted in batches of `batch_size`, each one
+    committed on its own, and `progress(result)` is called after every
+    batch. Returns an ImportResult whose `errors` lists the
+    (row number, message) of the invalid rows, numbered from 2 as in a
+    spreadsheet with a header row.
+    """
+    result = ImportResult(rows=0, products=0, specifications=0, errors=[])
+    numbered_rows = enumerate(rows, start=2)
+    while True:
+        batch = list(islice(numbered_rows, batch_size))
+        if not batch:
+            break
+        parsed_rows = []
+        for number, row in batch:
+            try:
+                parsed_rows.append(parse_catalog_row(row))
+            except ValueError as err:
+                result.errors.append((number, str(err)))
+        products_created, specifications_created = 0, 0
+        if parsed_rows:
+            try:
+                products_created, specifications_created = \
+                    import_catalog_batch(parsed_rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        result = result._replace(
+            rows=result.rows + len(batch),
+            products=result.products + products_created,
+            specifications=result.specifications + specifications_created)
+        if progress is not None:
+            progress(result)
+    return result
+
+
+# Stock alerts. Operations that change a stock re-evaluate the products
+# they touched: a product falling below its minimum gets a StockAlert,
+# which is dropped once it is back at its minimum. Alerts are collected for
+# STOCK_ALERT_WINDOW seconds and then sent together, by the mail worker,
+# in one digest per recipient.
+
+def evaluate_stock_alerts(stock, product_ids):
+    """Stage the alerts of `product_ids`, the caller commits"""
+    product_ids = set(product_ids)
+    if not product_ids:
+        return
+    totals = db.session.query(
+        Product.id, Product.stock_minimum,
+        func.coalesce(func.sum(StockProduct.amount), 0)).outerjoin(
+        StockProduct, (StockProduct.product_id == Product.id) &
+        (StockProduct.stock_id == stock.id)).filter(
+        Product.id.in_(product_ids)).group_by(Product.id).all()
+    below = [{'stock_id': stock.id,
+              'product_id': product_id,
+              'amount': total,
+              'stock_minimum': stock_minimum,
+              'created_on': datetime.utcnow()}
+             for product_id, stock_minimum, total in totals
+             if total < stock_minimum]
+    if below:
+        # Products already below their minimum keep their alert
+        statement = insert(StockAlert.__table__).values(below)
+        db.session.execute(statement.on_conflict_do_update(
+            constraint='unique_stock_alert',
+            set_={'amount': statement.excluded.amount,
+                  'stock_minimum': statement.excluded.stock_minimum}))
+    StockAlert.query.filter(
+        StockAlert.stock_id == stock.id,
+        StockAlert.product_id.in_(
+            product_ids.difference(alert['product_id'] for alert in below)),
+    ).delete(synchronize_session=False)
+
+
+def queue_stock_alert_digests():
+    """
+    Queue a digest of the unsent alerts to each recipient once the oldest
+    of them is STOCK_ALERT_WINDOW seconds old. Return how many alerts were
+    sent.
+    """
+    window_start = datetime.utcnow() - timedelta(
+        seconds=current_app.config['STOCK_ALERT_WINDOW'])
+    alerts = StockAlert.query.join(StockAlert.product).options(
+        contains_eager(StockAlert.product)).filter(
+        StockAlert.sent_on.is_(None)).order_by(
+        Product.name).with_for_update(of=StockAlert).all()
+    if not alerts or min(a.created_on for a in alerts) > window_start:
+        db.session.rollback()
+        return 0
+    for email in User.get_stock_alert_emails():
+        send_email(recipients=[email],
+                   subject='Reativos abaixo do estoque mínimo',
+                   template='main/email/stock_alert',
+                   alerts=alerts)
+    for alert in alerts:
+        alert.sent_on = datetime.utcnow()
     db.session.commit()
+    return len(alerts)
+
+
+# Ledger helpers. They only stage rows in the current session, the
+# business operation calling them is responsible for committing.
+
+def create_add_transactions_from_order(order, stock):
+    """Insert one ADD Transaction per order item in a single statement"""
+    user_id = order.user.id if order.user else None
+    transactions = [
+        {
+            'user_id': user_id,
+            'product_id': order_item.item.product_id,
+            'stock_id': stock.id,
+            'lot_number': order_item.lot_number,
+            'amount': order_item.amount * order_item.item.units,
+            'category': Transaction.ADD,
+        } for order_item in order.order_items
+    ]
+    if transactions:
+        db.session.execute(
+            Transaction.__table__.insert().values(transactions))
 
 
 def create_sub_transaction(user, product, lot_number, amount, stock):
@@ -57,40 +554,51 @@ def create_sub_transaction(user, product, lot_number, amount, stock):
     transaction.amount = amount
     transaction.stock = stock
     transaction.category = Transaction.SUB
-
     db.session.add(transaction)
-    db.session.commit()
+    return transaction
 
 
 def get_product_by_name(name):
     return Product.query.filter_by(name=name).first()
 
 
-def create_product(name):
-    product = Product(name=name)
-    db.session.add(product)
-    db.session.commit()
-    return product
+def get_specifications_by_id(specification_ids):
+    """Specifications with their products, loaded in a single query"""
+    if not specification_ids:
+        return {}
+    specifications = Specification.query.options(
+        joinedload(Specification.product)).filter(
+        Specification.id.in_(set(specification_ids)))
+    return {specification.id: specification
+            for specification in specifications}
 
 
-def get_order_items_from_session():
-    if not session.get('order_items'):
-        session['order_items'] = []
-        return []
-    else:
-        return [jsonpickle.decode(item) for item in session.get('order_items')]
+def get_cart(user):
+    """
+    Transient OrderItems built from the cart of `user`, with their
+    specifications and products already loaded.
+    """
+    cart_items = CartItem.query.filter_by(user_id=user.id).order_by(
+        CartItem.id).all()
+    specifications = get_specifications_by_id(
+        [cart_item.specification_id for cart_item in cart_items])
+    return [OrderItem(item_id=cart_item.specification_id,
+                      item=specifications.get(cart_item.specification_id),
+                      amount=cart_item.amount,
+                      lot_number=cart_item.lot_number,
+                      expiration_date=cart_item.expiration_date)
+            for cart_item in cart_items]
 
 
-def add_order_item_to_session(order_item):
-    # See http://flask.pocoo.org/docs/0.12/api/#sessions
-    # Must be manually set
-    if not session.get('order_items'):
-        session['order_items'] = []
-    session['order_items'] += [order_item.toJSON()]
-    session.modified = True
+def add_order_item_to_cart(user, order_item):
+    CartItem(user_id=user.id,
+             specification_id=order_item.item_id,
+             amount=order_item.amount,
+             lot_number=order_item.lot_number,
+             expiration_date=order_item.expiration_date).create()
 
 
-def clear_order_items_session():
-    if not session.get('order_items'):
-        session['order_items'] = []
-    session['order_items'] = []
+def clear_cart(user, commit=True):
+    CartItem.query.filter_by(user_id=user.id).delete()
+    if commit:
+        db.session.commit()
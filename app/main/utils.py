@@ -1,13 +1,36 @@
 import csv
+import glob
+import hashlib
 import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from flask import make_response
+import xlsxwriter
+from flask import Response, current_app, stream_with_context
+from sqlalchemy import func, text
 
 from app.extensions import db
+from app.main.models import DataChange, encode_cursor, decode_cursor
+
+
+# Rows fetched from the server-side cursor (and written out) at a time
+EXPORT_CHUNK_SIZE = 1000
+# Bytes read at a time when streaming a file built on disk
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+EXPORTABLE_TABLES = ['products', 'stock_products', 'transactions', 'orders']
 
 
 def filter_table_name(source):
-    if source in ['products', 'stock_products', 'transactions', 'orders']:
+    if source in EXPORTABLE_TABLES:
         return source
     else:
         raise ValueError('{} is not a valid table name or \
@@ -40,7 +63,7 @@ export_stock_products_query = "SELECT \
 # select id, CASE WHEN t.category='1' THEN t.amount ELSE -t.amount END FROM transactions as t;
     # CASE WHEN t.category='1' THEN t.amount ELSE -t.amount END\
 
-export_transactions_query = "SELECT \
+export_transactions_select = "SELECT \
     t.id,\
     p.name as reativo,\
     CASE WHEN t.category='1' THEN t.amount ELSE -t.amount END as quantidade,\
@@ -51,11 +74,13 @@ export_transactions_query = "SELECT \
     FROM transactions as t\
         JOIN products as p ON (t.product_id = p.id)\
         JOIN stocks as s ON (t.stock_id = s.id)\
-        JOIN users as u ON (t.user_id = u.id)\
-    ORDER BY t.updated_on DESC;"
+        JOIN users as u ON (t.user_id = u.id)"
+
+export_transactions_query = export_transactions_select + \
+    " ORDER BY t.updated_on DESC;"
 
 
-export_orders_query = 'SELECT \
+export_orders_select = 'SELECT \
 o.id, \
 o.order_date at time zone \'utc\' at time zone \'America/Sao_Paulo\' as data, \
 u.email as email_usuario, \
@@ -66,6 +91,14 @@ o.financier as financiador, \
 o.notes as observacoes \
 FROM orders o JOIN users u ON o.user_id = u.id'
 
+export_orders_query = export_orders_select
+
+# Tables that can be exported incrementally: (select, alias of the table)
+INCREMENTAL_EXPORTS = {
+    'transactions': (export_transactions_select, 't'),
+    'orders': (export_orders_select, 'o'),
+}
+
 
 def get_query(table_name):
     table_name = filter_table_name(table_name)
@@ -83,22 +116,508 @@ def get_query(table_name):
     return query
 
 
-def export_table(table_name, output_file_name):
+def get_export_horizon():
+    """
+    Time before which no more rows of the incremental tables can be
+    committed.
+
+    updated_on is set when a row is flushed, not when it is committed, so a
+    transaction that is still open may commit rows older than rows already
+    visible. The horizon is the start of the oldest transaction that has
+    written to the database, or now, minus EXPORT_WATERMARK_LAG to absorb
+    the skew between the clocks of the application servers and the
+    database.
+    """
+    # pg_stat_activity is otherwise read once per transaction
+    db.session.execute('SELECT pg_stat_clear_snapshot()')
+    return db.session.execute(text(
+        "SELECT timezone('utc', least(clock_timestamp(), ( \
+            SELECT min(xact_start) FROM pg_stat_activity \
+            WHERE datname = current_database() \
+            AND backend_xid IS NOT NULL AND pid <> pg_backend_pid()))) \
+        - make_interval(secs => :lag)").bindparams(
+        lag=current_app.config['EXPORT_WATERMARK_LAG'])).scalar()
+
+
+def get_watermark(table_name):
+    """
+    Cursor of the most recently updated row of an incremental table, among
+    the rows older than the export horizon
+    """
+    row = db.session.execute(text(
+        'SELECT updated_on, id FROM {} WHERE updated_on < :horizon \
+        ORDER BY updated_on DESC, id DESC LIMIT 1'.format(
+            table_name)).bindparams(horizon=get_export_horizon())).first()
+    return encode_cursor(*row) if row else None
+
+
+def get_incremental_query(table_name, since, until):
+    """
+    Export query for the rows of `table_name` whose (updated_on, id) is
+    after `since` and up to `until`, both (datetime, id) tuples.
+    """
+    select, alias = INCREMENTAL_EXPORTS[table_name]
+    columns = '{0}.updated_on, {0}.id'.format(alias)
+    # Ordering by the columns, not the row, lets the index serve the order
+    return text(
+        select +
+        ' WHERE ({0}) > (:since_on, :since_id) \
+        AND ({0}) <= (:until_on, :until_id) ORDER BY {0}'.format(
+            columns)).bindparams(
+        since_on=since[0], since_id=since[1],
+        until_on=until[0], until_id=until[1])
+
+
+def stream_query(query, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield the column names of `query`, then its rows in lists of up to
+    `chunk_size`.
+
+    Rows are read through a server-side cursor on a dedicated connection,
+    so memory use does not depend on the size of the result.
+    """
+    with db.engine.connect() as connection:
+        result = connection.execution_options(
+            stream_results=True).execute(query)
+        yield result.keys()
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+
+def generate_csv(query, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the result of `query` as CSV, `chunk_size` rows at a time"""
+    chunks = stream_query(query, chunk_size)
+    buffer = io.StringIO()
+    csv_writer = csv.writer(buffer)
+    csv_writer.writerow(next(chunks))
+    for rows in chunks:
+        csv_writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def generate_ndjson(query, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the result of `query` as one JSON object per line"""
+    chunks = stream_query(query, chunk_size)
+    keys = next(chunks)
+    for rows in chunks:
+        yield ''.join(
+            json.dumps(dict(zip(keys, row)), default=str,
+                       ensure_ascii=False) + '\n'
+            for row in rows)
+
+
+def generate_xlsx(query, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield the result of `query` as an XLSX workbook.
+
+    XLSX is a zip archive that can only be written out once complete, so
+    the rows are written to a temporary file in constant memory mode
+    first, then the file is streamed.
+    """
+    with tempfile.TemporaryFile() as output:
+        workbook = xlsxwriter.Workbook(output, {
+            'constant_memory': True,
+            'default_date_format': 'dd/mm/yyyy hh:mm',
+        })
+        worksheet = workbook.add_worksheet()
+        chunks = stream_query(query, chunk_size)
+        worksheet.write_row(0, 0, next(chunks))
+        row_number = 1
+        for rows in chunks:
+            for row in rows:
+                worksheet.write_row(row_number, 0, row)
+                row_number += 1
+        workbook.close()
+        output.seek(0)
+        for data in iter(lambda: output.read(FILE_CHUNK_SIZE), b''):
+            yield data
+
+
+def gzip_chunks(chunks):
+    """Compress a stream of text chunks into a gzip stream on the fly"""
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# format: (mimetype, generator)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', generate_csv),
+    'csv.gz': ('application/gzip',
+               lambda query: gzip_chunks(generate_csv(query))),
+    'ndjson': ('application/x-ndjson', generate_ndjson),
+    'ndjson.gz': ('application/gzip',
+                  lambda query: gzip_chunks(generate_ndjson(query))),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.'
+             'spreadsheetml.sheet', generate_xlsx),
+}
+
+
+def negotiate_export_format(accept_mimetypes):
+    """Pick the export format best matching an Accept header, CSV first"""
+    mimetypes = {}
+    for export_format, (mimetype, _) in EXPORT_FORMATS.items():
+        mimetypes.setdefault(mimetype, export_format)
+    return mimetypes.get(accept_mimetypes.best_match(mimetypes), 'csv')
+
+
+def get_export(table_name, export_format='csv', since=None):
+    """
+    Return (mimetype, chunks, watermark) to export `table_name`.
+
+    For tables in INCREMENTAL_EXPORTS, `watermark` is the cursor to pass as
+    `since` on the next export, which then only includes the rows created
+    or updated in between. It is None for the other tables. The watermark
+    stays behind the export horizon, so the rows updated recently may be
+    exported again by the next export.
+    """
     query = get_query(table_name)
-    memory = io.StringIO()
-    csv_writer = csv.writer(memory)
-    db_response = db.session.execute(query)
-    rows = db_response.fetchall()
-    csv_writer.writerow([header for header in db_response.keys()])
-    csv_writer.writerows(rows)
-    response = make_response(memory.getvalue())
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError('{} is not a valid export format'.format(
+            export_format))
+    watermark = None
+    if table_name in INCREMENTAL_EXPORTS:
+        watermark = get_watermark(table_name)
+        if since is not None:
+            since_key = decode_cursor(since)
+            until_key = since_key
+            if watermark is not None:
+                until_key = max(since_key, decode_cursor(watermark))
+            query = get_incremental_query(table_name, since_key, until_key)
+            watermark = encode_cursor(*until_key)
+    elif since is not None:
+        raise ValueError('{} can not be exported incrementally'.format(
+            table_name))
+    mimetype, generate = EXPORT_FORMATS[export_format]
+    return mimetype, generate(query), watermark
+
+
+def write_export(chunks, output_file):
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        output_file.write(chunk)
+
+
+def export_table(table_name, export_format='csv', since=None):
+    mimetype, chunks, watermark = get_export(
+        table_name, export_format, since)
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
     response.headers['Content-Disposition'] = \
-        'attachment; filename={}'.format(output_file_name)
-    response.mimetype = 'text/csv'
+        'attachment; filename={}.{}'.format(table_name, export_format)
+    if watermark is not None:
+        response.headers['X-Export-Watermark'] = watermark
+
+    return response
+
+
+# Tables read by the export of each table, used to compute its data version.
+# Writes to them are recorded by the triggers of models.DATA_CHANGE_TABLES
+EXPORT_SOURCE_TABLES = {
+    'products': ['products', 'specifications'],
+    'stock_products': ['stock_products', 'products', 'stocks'],
+    'transactions': ['transactions', 'products', 'stocks', 'users'],
+    'orders': ['orders', 'users'],
+}
+
+EXPORT_JOB_ID = re.compile(r'^(?P<table>\w+)-(?P<version>[0-9a-f]{16})'
+                           r'\.(?P<format>[\w.]+)$')
 
+_export_executor = None
+_export_executor_lock = threading.Lock()
+
+
+def get_export_executor():
+    global _export_executor
+    with _export_executor_lock:
+        if _export_executor is None:
+            _export_executor = ThreadPoolExecutor(
+                max_workers=current_app.config['EXPORT_JOB_WORKERS'])
+    return _export_executor
+
+
+def get_data_version(table_name):
+    """
+    Hash that changes whenever the data exported for `table_name` changes.
+
+    It combines how many writing statements were committed to every table
+    read by the export, as recorded in data_changes. The count is read
+    with the data, so a version is never reused once a write to those
+    tables commits.
+    """
+    rows = db.session.query(
+        DataChange.table_name, func.count()).filter(
+        DataChange.table_name.in_(EXPORT_SOURCE_TABLES[table_name])).group_by(
+        DataChange.table_name).order_by(DataChange.table_name).all()
+    return hashlib.sha1(repr(rows).encode('utf-8')).hexdigest()[:16]
+
+
+def get_export_job_path(job_id):
+    """Path of the cached result of the export job `job_id`"""
+    match = EXPORT_JOB_ID.match(job_id)
+    if not match or match.group('format') not in EXPORT_FORMATS:
+        raise ValueError('{} is not a valid export job'.format(job_id))
+    filter_table_name(match.group('table'))
+    return os.path.join(current_app.config['EXPORT_CACHE_DIR'], job_id)
+
+
+def is_stale_export_job(path):
+    """
+    Whether the partial file at `path` was left behind by a job that died,
+    that is, it was not written to for EXPORT_JOB_TIMEOUT seconds
+    """
+    return time.time() - os.path.getmtime(path) > \
+        current_app.config['EXPORT_JOB_TIMEOUT']
+
+
+def get_export_job_status(job_id):
+    """'ready', 'running', 'failed' or None if there is no such job"""
+    path = get_export_job_path(job_id)
+    if os.path.exists(path):
+        return 'ready'
+    try:
+        stale = is_stale_export_job(path + '.part')
+    except FileNotFoundError:
+        pass
+    else:
+        return 'failed' if stale else 'running'
+    if os.path.exists(path + '.error'):
+        return 'failed'
+    return None
+
+
+def start_export_job(table_name, export_format='csv'):
+    """
+    Export `table_name` in the background and return the job id.
+
+    Results are cached on disk, keyed by table, data version and format, so
+    the job of an unchanged table is only run once.
+    """
+    filter_table_name(table_name)
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError('{} is not a valid export format'.format(
+            export_format))
+    job_id = '{}-{}.{}'.format(
+        table_name, get_data_version(table_name), export_format)
+    path = get_export_job_path(job_id)
+    if os.path.exists(path):
+        return job_id
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        if is_stale_export_job(path + '.part'):
+            os.remove(path + '.part')
+    except FileNotFoundError:
+        pass
+    try:
+        # Creating the partial file claims the job for this process
+        open(path + '.part', 'x').close()
+    except FileExistsError:
+        return job_id
+    if os.path.exists(path + '.error'):
+        os.remove(path + '.error')
+    get_export_executor().submit(
+        run_export_job, current_app._get_current_object(),
+        table_name, export_format, path)
+    return job_id
+
+
+def keep_export_job_alive(path, stop, interval):
+    """
+    Touch the partial file at `path` every `interval` seconds until `stop`
+    is set, so a job still building its result, such as a XLSX workbook
+    written out only at the end, is not taken for a dead one
+    """
+    while not stop.wait(interval):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return
+
+
+def remove_superseded_exports(table_name, export_format, directory, grace):
+    """
+    Remove the results of previous data versions of `table_name`, once
+    the result that replaced each one has been ready for `grace` seconds.
+    Until then, clients told that a job was ready can still download it.
+    """
+    paths = sorted(glob.glob(os.path.join(
+        directory, '{}-*.{}'.format(table_name, export_format))),
+        key=os.path.getmtime)
+    now = time.time()
+    for old_path, new_path in zip(paths, paths[1:]):
+        if now - os.path.getmtime(new_path) > grace:
+            os.remove(old_path)
+
+
+def run_export_job(app, table_name, export_format, path):
+    with app.app_context():
+        stop = threading.Event()
+        threading.Thread(
+            target=keep_export_job_alive,
+            args=(path + '.part', stop,
+                  app.config['EXPORT_JOB_TIMEOUT'] / 4),
+            daemon=True).start()
+        try:
+            _, chunks, _ = get_export(table_name, export_format)
+            with open(path + '.part', 'wb') as output_file:
+                write_export(chunks, output_file)
+            os.replace(path + '.part', path)
+            remove_superseded_exports(
+                table_name, export_format, os.path.dirname(path),
+                app.config['EXPORT_RESULT_GRACE'])
+            app.logger.info(f'{os.path.basename(path)} exported')
+        except Exception as err:
+            app.logger.exception(f'{os.path.basename(path)} export failed')
+            with open(path + '.error', 'w') as error_file:
+                error_file.write(str(err))
+            os.remove(path + '.part')
+        finally:
+            stop.set()
+            db.session.remove()
+
+
+class ZipStream:
+    """Write-only file object for zipfile, drained with `pop`"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def export_csv_from_snapshot(engine, snapshot_id, query, path):
+    """
+    Write the result of `query`, as seen by the exported snapshot
+    `snapshot_id`, to a CSV file at `path`. Returns the number of rows.
+    """
+    rows_count = 0
+    connection = engine.connect().execution_options(
+        isolation_level='REPEATABLE READ')
+    try:
+        with connection.begin(), open(path, 'w', newline='') as output:
+            connection.execute(text('SET TRANSACTION SNAPSHOT :snapshot_id'),
+                               snapshot_id=snapshot_id)
+            result = connection.execution_options(
+                stream_results=True).execute(query)
+            csv_writer = csv.writer(output)
+            csv_writer.writerow(result.keys())
+            while True:
+                rows = result.fetchmany(EXPORT_CHUNK_SIZE)
+                if not rows:
+                    break
+                csv_writer.writerows(rows)
+                rows_count += len(rows)
+    finally:
+        connection.close()
+    return rows_count
+
+
+def generate_bundle(table_names=None):
+    """
+    Return the chunks of a ZIP archive with one CSV per table and a
+    manifest.json holding the row counts and the snapshot timestamp.
+    Repeated tables are exported once. The table names are checked right
+    away, not when the first chunk is read.
+
+    The tables are exported concurrently, each on its own connection, and
+    all of them read the same REPEATABLE READ snapshot (exported by a
+    leader transaction), so the files are consistent with each other.
+    """
+    queries = {name: get_query(name)
+               for name in dict.fromkeys(table_names or EXPORTABLE_TABLES)}
+    return _generate_bundle(queries)
+
+
+def _generate_bundle(queries):
+    engine = db.engine
+    stream = ZipStream()
+    with tempfile.TemporaryDirectory() as directory, \
+            engine.connect() as leader, \
+            ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        leader = leader.execution_options(isolation_level='REPEATABLE READ')
+        with leader.begin():
+            snapshot_id, snapshot_at = leader.execute(
+                'SELECT pg_export_snapshot(), now()').first()
+            futures = {
+                executor.submit(
+                    export_csv_from_snapshot, engine, snapshot_id,
+                    query, os.path.join(directory, name + '.csv')
+                ): name for name, query in queries.items()
+            }
+            manifest = {'snapshot_at': snapshot_at.isoformat(), 'tables': {}}
+            with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for future in as_completed(futures):
+                    name = futures[future]
+                    path = os.path.join(directory, name + '.csv')
+                    manifest['tables'][name] = {
+                        'file': name + '.csv',
+                        'rows': future.result(),
+                    }
+                    info = zipfile.ZipInfo.from_file(path, name + '.csv')
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    with open(path, 'rb') as source, \
+                            archive.open(info, 'w') as destination:
+                        for data in iter(
+                                lambda: source.read(FILE_CHUNK_SIZE), b''):
+                            destination.write(data)
+                            yield stream.pop()
+                    os.remove(path)
+                archive.writestr('manifest.json',
+                                 json.dumps(manifest, indent=2))
+    yield stream.pop()
+
+
+def export_bundle(table_names=None):
+    response = Response(stream_with_context(generate_bundle(table_names)),
+                        mimetype='application/zip')
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=bundle.zip'
     return response
 
 
+def read_table_rows(path):
+    """
+    Yield the rows of a CSV or XLSX file as dicts keyed by the header row.
+    Only the first sheet of XLSX files is read.
+    """
+    if path.lower().endswith('.xlsx'):
+        import openpyxl
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = [str(column).strip() if column is not None else ''
+                      for column in next(rows, [])]
+            for row in rows:
+                yield dict(zip(header, row))
+        finally:
+            workbook.close()
+    else:
+        with open(path, newline='', encoding='utf-8-sig') as csv_file:
+            for row in csv.DictReader(csv_file):
+                yield {column.strip(): value for column, value in row.items()
+                       if column is not None}
+
+
 def stock_is_at_minimum(catalog_product):
     if catalog_product.count_amount_stock_products(
     ) <= catalog_product.min_stock:
@@ -1,17 +1,14 @@
 # TODO: export logger from logger.py
-import jsonpickle
-
-from flask import (Blueprint, render_template, redirect,
-                   url_for, current_app, session, request, flash)
+from flask import (Blueprint, render_template, redirect, url_for,
+                   current_app, request, flash, abort, jsonify, send_file)
 import sqlalchemy
 from flask_login import current_user
 
-from app.extensions import db
 from app.logger import logger
 from app.auth.decorators import restrict_to_logged_users, permission_required
 from app.auth.models import Permission, User
 from .models import (
-    Order, OrderItem, Transaction, Stock, StockProduct, Product, Specification)
+    Order, OrderItem, Transaction, Stock, StockProduct, Product)
 from . import forms
 from . import services as svc
 from . import utils
@@ -21,6 +18,20 @@ blueprint = Blueprint('main', __name__)
 blueprint.before_request(restrict_to_logged_users)
 
 
+def get_keyset_page(query, column):
+    """Page `query` with the cursor and page size from the query string"""
+    per_page = request.args.get(
+        'per_page', current_app.config['ITEMS_PER_PAGE'], type=int)
+    per_page = max(1, min(per_page, current_app.config['MAX_ITEMS_PER_PAGE']))
+    try:
+        return query.keyset_page(column,
+                                 after=request.args.get('after'),
+                                 before=request.args.get('before'),
+                                 per_page=per_page)
+    except ValueError:
+        abort(404)
+
+
 @blueprint.route('/', methods=['GET'])
 @permission_required(Permission.VIEW)
 def index():
@@ -31,16 +42,10 @@ def index():
 @permission_required(Permission.VIEW)
 def show_stock():
     template = 'main/index.html'
-    products = svc.get_products_in_stock(svc.get_stock())
-
     stock = svc.get_stock()
-    stock_products = sorted(
-        [sp for sp in stock.stock_products if sp.amount > 0],
-        key=lambda sp: sp.product.name,
-    )
+    products = svc.get_products_in_stock(stock)
     return render_template(template,
-                           products=products,
-                           stock_products=stock_products)
+                           products=products)
 
 
 @blueprint.route('/catalog', methods=['GET'])
@@ -48,7 +53,8 @@ def show_stock():
 def show_catalog():
     template = 'main/list-products.html'
     view = 'main.show_catalog'
-    products = Product.query.order_by(Product.name).all()
+    products = Product.query.with_display_relations().order_by(
+        Product.name).all()
     return render_template(template,
                            products=products)
 
@@ -58,10 +64,11 @@ def show_catalog():
 def list_transactions():
     template = 'main/list-transactions.html'
     view = 'main.list_transactions'
-    transactions = Transaction.query.order_by(
-        Transaction.updated_on.desc()).all()
+    page = get_keyset_page(Transaction.query.with_display_relations(),
+                           Transaction.updated_on)
     return render_template(template,
-                           transactions=transactions)
+                           transactions=page.items,
+                           page=page)
 
 
 @blueprint.route('/orders', methods=['GET'])
@@ -69,9 +76,11 @@ def list_transactions():
 def list_orders():
     template = 'main/list-orders.html'
     view = 'main.list_orders'
-    orders = Order.query.order_by(Order.order_date.desc()).all()
+    page = get_keyset_page(Order.query.with_display_relations(),
+                           Order.order_date)
     return render_template(template,
-                           orders=orders)
+                           orders=page.items,
+                           page=page)
 
 
 # TODO: Implement this method:
@@ -86,19 +95,13 @@ def delete_transaction(transaction_id):
 @permission_required(Permission.EDIT)
 def purchase_product():
     logger.info('purchase_product()')
-    specifications = svc.get_specifications()
-    form_context = {
-        'specs': specifications,
-    }
-    form = forms.OrderItemForm(**form_context)
+    form = forms.OrderItemForm()
 
-    order_items = svc.get_order_items_from_session()
-    for order_item in order_items:
-        order_item.item = Specification.query.get(order_item.item_id)
+    order_items = svc.get_cart(current_user)
 
     if request.method == 'POST':
         if form.cancel.data is True:
-            svc.clear_order_items_session()
+            svc.clear_cart(current_user)
             return redirect(url_for('.purchase_product'))
         if form.finish_order.data is True:
             if order_items:
@@ -109,7 +112,7 @@ def purchase_product():
         if form.validate():
             order_item = OrderItem()
             form.populate_obj(order_item)
-            svc.add_order_item_to_session(order_item)
+            svc.add_order_item_to_cart(current_user, order_item)
             flash('Reativo adicionado ao carrinho', 'success')
             return redirect(url_for('.purchase_product'))
     return render_template('main/create-order.html',
@@ -121,18 +124,13 @@ def purchase_product():
 def checkout():
     form = forms.OrderForm()
     stock = svc.get_stock()
-    if session.get('order_items') is None:
-        session['order_items'] = []
-    order_items = [jsonpickle.decode(item)
-                   for item in session.get('order_items')]
-    for order_item in order_items:
-        order_item.item = Specification.query.get(order_item.item_id)
-    logger.info('Retrieve unpickled order_items from session')
+    order_items = svc.get_cart(current_user)
+    logger.info('Retrieve order_items from cart')
     if request.method == 'POST':
         logger.info('POSTing to checkout')
         if form.cancel.data is True:
-            logger.info('Cancel order, cleaning session')
-            session['order_items'] = []
+            logger.info('Cancel order, cleaning cart')
+            svc.clear_cart(current_user)
             return redirect(url_for('.purchase_product'))
         if order_items:
             if form.validate():
@@ -142,39 +140,18 @@ def checkout():
                     'populating order with form data and order_items')
                 form.populate_obj(order)
                 order.order_items = order_items
-                order.user = current_user
-                db.session.add(order)
+                order.user = current_user.user
                 try:
                     logger.info('Saving order to database...')
-                    for order_item in order.order_items:
-                        logger.info(
-                            'Adding %s to stock' % order_item)
-                        product = order_item.item.product
-                        lot_number = order_item.lot_number
-                        total_units = order_item.amount * order_item.item.units
-                        expiration_date = order_item.expiration_date
-                        logger.info('stock.add({}, {}, {}, {})'.format(
-                            product, lot_number, expiration_date, total_units))
-                        stock.add(
-                            product,
-                            lot_number,
-                            expiration_date,
-                            total_units)
-                        order_item.added_to_stock = True
-                        db.session.add(order_item)
-                    logger.info('Comitting session...')
-                    db.session.commit()
-                    logger.info(
-                        'Creating transactions from order...')
-                    svc.create_add_transactions_from_order(order, stock)
+                    # Committed together with the order
+                    svc.clear_cart(current_user, commit=False)
+                    svc.receive_order(order, stock)
                     logger.info(
                         'Flashing success and returning to index')
                     flash('Ordem executada com sucesso', 'success')
-                    session['order_items'] = []
                     return redirect(url_for('.index'))
                 except (ValueError) as err:
-                    db.session.rollback()
-                    session['order_items'] = []
+                    svc.clear_cart(current_user)
                     logger.error('Could not save the order to db. Rollback.')
                     logger.error(err)
                     flash('Algo deu errado, contate um administrador!')
@@ -194,16 +171,7 @@ def checkout():
 def consume_product():
     logger.info('consume_product()')
     stock = svc.get_stock()
-    stock_products = sorted(
-        [sp for sp in stock.stock_products if sp.amount > 0],
-        key=lambda sp: sp.product.name,
-    )
-    for stock_product in stock_products:
-        stock_product.manufacturer = svc.get_manufacturer_by_lot_number(stock_product.lot_number)
-    form_context = {
-        'stock_products': stock_products,
-    }
-    form = forms.ConsumeProductForm(**form_context)
+    form = forms.ConsumeProductForm(stock=stock)
 
     if form.validate_on_submit():
         logger.info('POSTing a valid form to consume_product')
@@ -214,22 +182,15 @@ def consume_product():
             logger.info(
                 'Retrieving info from selected_stock_product')
             product = selected_stock_product.product
+            # Read before the commit expires the loaded objects
+            product_name = product.name
             lot_number = selected_stock_product.lot_number
             amount = form.amount.data
-            stock.subtract(product, lot_number, amount)
-            logger.info('Commiting subtraction')
             consumer_user = User.query.filter_by(id=form.consumer_id.data).first()
-            db.session.commit()
-            logger.info('Creating sub-transaction')
-            svc.create_sub_transaction(
-                consumer_user,
-                product,
-                lot_number,
-                amount,
-                stock
-            )
+            logger.info('Subtracting from stock and creating sub-transaction')
+            svc.consume(stock, product, lot_number, amount, consumer_user)
             flash('{} unidades de {} removidas do estoque com sucesso!'.format(
-                form.amount.data, selected_stock_product.product.name),
+                form.amount.data, product_name),
                 'success',
             )
 
@@ -244,6 +205,37 @@ def consume_product():
     return render_template('main/consume-product.html', form=form)
 
 
+@blueprint.route('/products/consume/fefo', methods=['GET', 'POST'])
+@permission_required(Permission.EDIT)
+def consume_product_fefo():
+    logger.info('consume_product_fefo()')
+    stock = svc.get_stock()
+    form = forms.ConsumeByProductForm(stock=stock)
+
+    if form.validate_on_submit():
+        logger.info('POSTing a valid form to consume_product_fefo')
+        try:
+            product = Product.query.get(form.product_id.data)
+            product_name = product.name
+            consumer_user = User.query.filter_by(id=form.consumer_id.data).first()
+            taken = svc.consume_fefo(
+                stock, product, form.amount.data, consumer_user)
+            flash('{} unidades de {} removidas do estoque com sucesso! '
+                  'Lotes: {}'.format(
+                      form.amount.data, product_name,
+                      ', '.join(f'{lot} ({units})' for lot, units in taken)),
+                  'success')
+            return redirect(url_for('.consume_product_fefo'))
+        except ValueError as err:
+            logger.error(err)
+            form.amount.errors.append(
+                'Não há o suficiente desse reativo em estoque.')
+        except Exception:
+            flash('Erro inesperado, contate o administrador.', 'danger')
+
+    return render_template('main/consume-product-fefo.html', form=form)
+
+
 @blueprint.route('/products/add', methods=['GET', 'POST'])
 @permission_required(Permission.EDIT)
 def add_product_to_catalog():
@@ -272,18 +264,15 @@ def add_specification_to_product(product_id):
     form = forms.AddSpecificationForm(product.id)
     if form.validate_on_submit():
         try:
-            specification = Specification(
-                catalog_number=form.catalog_number.data,
+            svc.create_specification(
+                product_id=product_id,
                 manufacturer=form.manufacturer.data,
+                catalog_number=form.catalog_number.data,
                 units=form.units.data,
-                product_id=product_id,
             )
-            db.session.add(specification)
-            db.session.commit()
             flash('Especificação adicionada com sucesso.', 'success')
             return redirect(url_for('.detail_product', product_id=product.id))
         except sqlalchemy.exc.IntegrityError:
-            db.session.rollback()
             flash('Já existe uma especificação com esse catálogo e fabricante',
                   'danger')
     return render_template('main/create-specification.html',
@@ -303,8 +292,119 @@ def detail_product(product_id):
                            specifications=specifications)
 
 
+def get_search_args():
+    """Searched text and result limit of a typeahead search request"""
+    limit = request.args.get('limit', svc.SEARCH_LIMIT, type=int)
+    return (request.args.get('q', ''),
+            max(1, min(limit, svc.MAX_SEARCH_LIMIT)))
+
+
+def search_response(results, **fields):
+    """
+    Results in the format expected by select2, `fields` maps extra result
+    keys to functions of the result id
+    """
+    return jsonify(results=[
+        dict(id=id, text=text,
+             **{key: field(id) for key, field in fields.items()})
+        for id, text in results])
+
+
+@blueprint.route('/search/products')
+@permission_required(Permission.VIEW)
+def search_products():
+    text, limit = get_search_args()
+    if request.args.get('in_stock'):
+        results = svc.search_products_in_stock(svc.get_stock(), text, limit)
+    else:
+        results = svc.search_catalog(text, limit)
+    return search_response(results, url=lambda id: url_for(
+        '.detail_product', product_id=id))
+
+
+@blueprint.route('/search/specifications')
+@permission_required(Permission.VIEW)
+def search_specifications():
+    return search_response(svc.search_specifications(*get_search_args()))
+
+
+@blueprint.route('/search/stock-products')
+@permission_required(Permission.VIEW)
+def search_stock_products():
+    return search_response(
+        svc.search_stock_products(svc.get_stock(), *get_search_args()))
+
+
+@blueprint.route('/search/users')
+@permission_required(Permission.EDIT)
+def search_users():
+    return search_response(svc.search_users(*get_search_args()))
+
+
+@blueprint.route('/export/<string:table>/job')
+@permission_required(Permission.VIEW)
+def export_job(table):
+    try:
+        job_id = utils.start_export_job(
+            table, request.args.get('format', 'csv'))
+    except ValueError:
+        abort(404)
+    return redirect(url_for('.export_job_status', job_id=job_id))
+
+
+@blueprint.route('/export/jobs/<string:job_id>')
+@permission_required(Permission.VIEW)
+def export_job_status(job_id):
+    try:
+        status = utils.get_export_job_status(job_id)
+    except ValueError:
+        abort(404)
+    if status is None:
+        abort(404)
+    download_url = url_for('.download_export', job_id=job_id)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(id=job_id, status=status, download_url=download_url)
+    return render_template('main/export-job.html', job_id=job_id,
+                           status=status, download_url=download_url)
+
+
+@blueprint.route('/export/jobs/<string:job_id>/download')
+@permission_required(Permission.VIEW)
+def download_export(job_id):
+    try:
+        status = utils.get_export_job_status(job_id)
+    except ValueError:
+        abort(404)
+    if status != 'ready':
+        abort(404)
+    match = utils.EXPORT_JOB_ID.match(job_id)
+    mimetype, _ = utils.EXPORT_FORMATS[match.group('format')]
+    return send_file(
+        utils.get_export_job_path(job_id), mimetype=mimetype,
+        as_attachment=True, attachment_filename='{}.{}'.format(
+            match.group('table'), match.group('format')))
+
+
+@blueprint.route('/export/bundle')
+@permission_required(Permission.VIEW)
+def export_bundle():
+    tables = request.args.get('tables')
+    table_names = tables.split(',') if tables else None
+    try:
+        response = utils.export_bundle(table_names)
+    except ValueError:
+        abort(404)
+    return response
+
+
 @blueprint.route('/export/<string:table>')
 @permission_required(Permission.VIEW)
 def export(table):
-    response = utils.export_table(table, table + '.csv')
+    export_format = request.args.get('format') or \
+        utils.negotiate_export_format(request.accept_mimetypes)
+    try:
+        response = utils.export_table(table, export_format,
+                                      since=request.args.get('since'))
+    except ValueError:
+        abort(404)
     return response
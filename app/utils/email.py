@@ -1,16 +1,29 @@
-from threading import Thread
+import smtplib
+import time
+from datetime import datetime
 
 from flask import current_app, render_template
-from flask_mail import Message
-from app.extensions import mail
+from flask_mail import Message, BadHeaderError
+from app.extensions import db, mail
+from app.main.models import OutboxEmail
 
 
-def _send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+def to_message(email):
+    """Flask-Mail message of an OutboxEmail"""
+    return Message(subject=email.subject,
+                   sender=email.sender,
+                   recipients=email.recipients.split(','),
+                   body=email.body,
+                   html=email.html,
+                   charset='utf-8')
 
 
 def send_email(recipients, subject, template, sync=False, **kwargs):
+    """
+    Queue an email in the outbox. It is committed with the current
+    transaction and delivered by `flask mail-worker`. With `sync`, the
+    email is sent right away instead.
+    """
     msg = Message(
         subject=subject,
         sender=current_app.config.get('MAIL_SENDER'),
@@ -19,10 +32,85 @@ def send_email(recipients, subject, template, sync=False, **kwargs):
     msg.body = render_template(template + '.txt', **kwargs)
     msg.html = render_template(template + '.html', **kwargs)
 
-    real_app_instance = current_app._get_current_object()
-
     if sync:
         mail.send(msg)
     else:
-        Thread(target=_send_async_email,
-               args=(real_app_instance, msg)).start()
+        db.session.add(OutboxEmail(sender=msg.sender,
+                                   recipients=','.join(msg.recipients),
+                                   subject=msg.subject,
+                                   body=msg.body,
+                                   html=msg.html))
+
+
+def due_emails():
+    return OutboxEmail.query.filter(
+        OutboxEmail.sent_on.is_(None),
+        OutboxEmail.next_attempt_on <= datetime.utcnow(),
+        OutboxEmail.attempts < current_app.config['MAIL_MAX_ATTEMPTS'])
+
+
+def deliver_outbox_batch(connection, batch_size):
+    """
+    Claim up to `batch_size` due emails and send them through the open
+    Flask-Mail `connection`. Emails locked by other workers are skipped.
+    Return how many emails were claimed.
+
+    Emails the server refuses are retried later. Errors that break the
+    connection are raised once the emails already sent are recorded.
+    An email sent right before the worker dies may be sent again.
+    """
+    emails = due_emails().order_by(
+        OutboxEmail.next_attempt_on, OutboxEmail.id).limit(
+        batch_size).with_for_update(skip_locked=True).all()
+    try:
+        for email in emails:
+            try:
+                connection.send(to_message(email))
+            except (smtplib.SMTPResponseException,
+                    smtplib.SMTPRecipientsRefused, BadHeaderError) as err:
+                current_app.logger.warning(
+                    f'Email {email.id} refused: {err}')
+                email.record_failure(
+                    err, current_app.config['MAIL_RETRY_DELAY'])
+            except OSError as err:
+                email.record_failure(
+                    err, current_app.config['MAIL_RETRY_DELAY'])
+                raise
+            else:
+                email.sent_on = datetime.utcnow()
+    finally:
+        db.session.commit()
+    return len(emails)
+
+
+def run_mail_worker(batch_size, interval, once=False, jobs=()):
+    """
+    Deliver the outbox until interrupted, looking for due emails every
+    `interval` seconds. A SMTP connection is kept open while there are
+    emails to send. With `once`, return after a single round.
+
+    jobs: callables run before each round, to queue periodic emails
+
+    A round that fails, in a job or in the database, is logged and the
+    next one is tried after `interval` seconds.
+    """
+    while True:
+        try:
+            for job in jobs:
+                job()
+            if due_emails().first() is not None:
+                try:
+                    with mail.connect() as connection:
+                        while deliver_outbox_batch(
+                                connection, batch_size) == batch_size:
+                            pass
+                except OSError as err:
+                    current_app.logger.error(
+                        f'Could not deliver emails: {err}')
+        except Exception:
+            current_app.logger.exception('Mail worker round failed')
+        # Don't hold a transaction open while sleeping
+        db.session.rollback()
+        if once:
+            return
+        time.sleep(interval)
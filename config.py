@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 from dotenv import load_dotenv
 
@@ -20,7 +21,9 @@ class Config:
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
 
     # Flask SQLAlchemy
-    SQLALCHEMY_COMMIT_ON_TEARDOWN = True
+    # Views and services commit their own work, nothing is committed at
+    # the end of the request
+    SQLALCHEMY_COMMIT_ON_TEARDOWN = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
 
@@ -32,6 +35,12 @@ class Config:
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = os.environ.get('MAIL_PORT')
     MAIL_USE_TLS = True
+    # Outbox delivery (flask mail-worker). A refused email is retried after
+    # MAIL_RETRY_DELAY seconds, doubling at each attempt
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE', 50))
+    MAIL_WORKER_INTERVAL = int(os.environ.get('MAIL_WORKER_INTERVAL', 5))
+    MAIL_RETRY_DELAY = 60
+    MAIL_MAX_ATTEMPTS = 8
 
     # Flask Login
     LOGIN_MESSAGE = 'É necessário ralizar login para acessar essa página'
@@ -39,6 +48,33 @@ class Config:
     # Business rules
     MAIN_ENDPOINT = os.environ.get('MAIN_ENDPOINT', 'main.index')
 
+    # Pagination
+    ITEMS_PER_PAGE = int(os.environ.get('ITEMS_PER_PAGE', 50))
+    MAX_ITEMS_PER_PAGE = 500
+
+    # Seconds a process may authorize a user with the cached id, email,
+    # confirmed flag and permissions without seeing changes made by other
+    # processes
+    PRINCIPAL_CACHE_TTL = int(os.environ.get('PRINCIPAL_CACHE_TTL', 30))
+    # Most principals cached by each process, the least recently used are
+    # dropped first
+    PRINCIPAL_CACHE_SIZE = int(os.environ.get('PRINCIPAL_CACHE_SIZE', 1000))
+
+    # Seconds low-stock alerts are collected before a digest is sent
+    STOCK_ALERT_WINDOW = int(os.environ.get('STOCK_ALERT_WINDOW', 15 * 60))
+
+    # Background exports
+    EXPORT_CACHE_DIR = os.environ.get('EXPORT_CACHE_DIR') or \
+        os.path.join(tempfile.gettempdir(), 'sms-exports')
+    EXPORT_JOB_WORKERS = int(os.environ.get('EXPORT_JOB_WORKERS', 2))
+    EXPORT_JOB_TIMEOUT = 60 * 60
+    # Seconds the result of a previous data version is kept after a newer
+    # one is ready, for the clients that were told it was ready
+    EXPORT_RESULT_GRACE = int(os.environ.get('EXPORT_RESULT_GRACE', 10 * 60))
+    # Seconds incremental export watermarks are kept behind the oldest
+    # open write transaction, see get_export_horizon
+    EXPORT_WATERMARK_LAG = int(os.environ.get('EXPORT_WATERMARK_LAG', 60))
+
 
 class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL')
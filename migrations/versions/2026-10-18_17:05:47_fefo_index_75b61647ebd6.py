@@ -0,0 +1,26 @@
+"""fefo index
+
+Revision ID: 75b61647ebd6
+Revises: 3cbc86a0a9d7
+Create Date: 2026-10-18 17:05:47.038363
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '75b61647ebd6'
+down_revision = '3cbc86a0a9d7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_stock_products_fefo', 'stock_products', ['stock_id', 'product_id', 'expiration_date', 'id'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_stock_products_fefo', table_name='stock_products', postgresql_concurrently=True)
@@ -0,0 +1,36 @@
+"""hot path indexes
+
+Revision ID: 0be1584fb7b1
+Revises: 75b61647ebd6
+Create Date: 2026-10-18 17:06:53.205416
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0be1584fb7b1'
+down_revision = '75b61647ebd6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY does not lock the tables for writes, but it
+    # can't run inside a transaction block
+    with op.get_context().autocommit_block():
+        op.create_index('ix_order_items_lot_number_item_id', 'order_items', ['lot_number', 'item_id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_orders_order_date_id', 'orders', ['order_date', 'id'], unique=False, postgresql_concurrently=True)
+        op.create_index(op.f('ix_specifications_product_id'), 'specifications', ['product_id'], unique=False, postgresql_concurrently=True)
+        op.create_index(op.f('ix_stock_products_expiration_date'), 'stock_products', ['expiration_date'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_transactions_updated_on_id', 'transactions', ['updated_on', 'id'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_transactions_updated_on_id', table_name='transactions', postgresql_concurrently=True)
+        op.drop_index(op.f('ix_stock_products_expiration_date'), table_name='stock_products', postgresql_concurrently=True)
+        op.drop_index(op.f('ix_specifications_product_id'), table_name='specifications', postgresql_concurrently=True)
+        op.drop_index('ix_orders_order_date_id', table_name='orders', postgresql_concurrently=True)
+        op.drop_index('ix_order_items_lot_number_item_id', table_name='order_items', postgresql_concurrently=True)
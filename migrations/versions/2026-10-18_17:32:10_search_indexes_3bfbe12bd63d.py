@@ -0,0 +1,29 @@
+"""search indexes
+
+Revision ID: 3bfbe12bd63d
+Revises: 74b159962f1f
+Create Date: 2026-10-18 17:32:10.839675
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3bfbe12bd63d'
+down_revision = '74b159962f1f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Autogenerate skips functional indexes, so these are written by hand
+    with op.get_context().autocommit_block():
+        op.create_index('ix_products_lower_name', 'products', [sa.text('lower(name) varchar_pattern_ops')], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_users_lower_email', 'users', [sa.text('lower(email) varchar_pattern_ops')], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_users_lower_email', table_name='users', postgresql_concurrently=True)
+        op.drop_index('ix_products_lower_name', table_name='products', postgresql_concurrently=True)
@@ -0,0 +1,123 @@
+"""product search vector
+
+Revision ID: e46b8b173dbf
+Revises: 3bfbe12bd63d
+Create Date: 2026-10-18 17:36:01.823219
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'e46b8b173dbf'
+down_revision = '3bfbe12bd63d'
+branch_labels = None
+depends_on = None
+
+
+# Same statements as app.main.models.PRODUCT_SEARCH_DDL when this revision
+# was written
+SEARCH_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION sms_unaccent(text) RETURNS text
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT translate(
+            $1,
+            'áàâãäéèêëíìîïóòôõöúùûüçñÁÀÂÃÄÉÈÊËÍÌÎÏÓÒÔÕÖÚÙÛÜÇÑ',
+            'aaaaaeeeeiiiiooooouuuucnAAAAAEEEEIIIIOOOOOUUUUCN')
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION sms_search_words(text) RETURNS text
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT regexp_replace(sms_unaccent(coalesce($1, '')),
+                              '[^[:alnum:]]+', ' ', 'g')
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION products_search_vector(
+        product_id integer, name text) RETURNS tsvector
+    LANGUAGE sql STABLE AS $$
+        SELECT setweight(to_tsvector('portuguese', sms_search_words(name)),
+                         'A')
+            || setweight(to_tsvector('portuguese', sms_search_words(
+                string_agg(concat_ws(' ', s.manufacturer, s.catalog_number),
+                           ' '))), 'B')
+        FROM specifications s WHERE s.product_id = $1
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION products_search_vector_trigger()
+    RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.search_vector := products_search_vector(NEW.id, NEW.name);
+        RETURN NEW;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION specifications_search_vector_trigger()
+    RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE products p
+        SET search_vector = products_search_vector(p.id, p.name)
+        WHERE p.id IN (SELECT product_id FROM changed_specifications);
+        IF TG_OP = 'UPDATE' THEN
+            UPDATE products p
+            SET search_vector = products_search_vector(p.id, p.name)
+            WHERE p.id IN (SELECT product_id FROM previous_specifications);
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE TRIGGER products_search_vector
+    BEFORE INSERT OR UPDATE OF name ON products
+    FOR EACH ROW EXECUTE PROCEDURE products_search_vector_trigger()
+    """,
+    """
+    CREATE TRIGGER specifications_search_vector_insert
+    AFTER INSERT ON specifications
+    REFERENCING NEW TABLE AS changed_specifications
+    FOR EACH STATEMENT EXECUTE PROCEDURE specifications_search_vector_trigger()
+    """,
+    """
+    CREATE TRIGGER specifications_search_vector_update
+    AFTER UPDATE ON specifications
+    REFERENCING OLD TABLE AS previous_specifications
+                NEW TABLE AS changed_specifications
+    FOR EACH STATEMENT EXECUTE PROCEDURE specifications_search_vector_trigger()
+    """,
+    """
+    CREATE TRIGGER specifications_search_vector_delete
+    AFTER DELETE ON specifications
+    REFERENCING OLD TABLE AS changed_specifications
+    FOR EACH STATEMENT EXECUTE PROCEDURE specifications_search_vector_trigger()
+    """,
+]
+
+
+def upgrade():
+    op.add_column('products', sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+    for statement in SEARCH_DDL:
+        op.execute(statement)
+    op.execute('UPDATE products SET search_vector = products_search_vector(id, name)')
+    with op.get_context().autocommit_block():
+        op.create_index('ix_products_search_vector', 'products', ['search_vector'], unique=False, postgresql_using='gin', postgresql_with={'fastupdate': 'off'}, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_products_search_vector', table_name='products', postgresql_concurrently=True)
+    op.execute('DROP TRIGGER specifications_search_vector_delete ON specifications')
+    op.execute('DROP TRIGGER specifications_search_vector_update ON specifications')
+    op.execute('DROP TRIGGER specifications_search_vector_insert ON specifications')
+    op.execute('DROP TRIGGER products_search_vector ON products')
+    op.execute('DROP FUNCTION specifications_search_vector_trigger()')
+    op.execute('DROP FUNCTION products_search_vector_trigger()')
+    op.execute('DROP FUNCTION products_search_vector(integer, text)')
+    op.execute('DROP FUNCTION sms_search_words(text)')
+    op.execute('DROP FUNCTION sms_unaccent(text)')
+    op.drop_column('products', 'search_vector')
@@ -0,0 +1,29 @@
+"""specification search indexes
+
+Revision ID: 8d2f4c1a9b7e
+Revises: e596ac399769
+Create Date: 2026-10-18 18:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2f4c1a9b7e'
+down_revision = 'e596ac399769'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Autogenerate skips functional indexes, so these are written by hand
+    with op.get_context().autocommit_block():
+        op.create_index('ix_specifications_lower_manufacturer', 'specifications', [sa.text('lower(manufacturer) varchar_pattern_ops')], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_specifications_lower_catalog_number', 'specifications', [sa.text('lower(catalog_number) varchar_pattern_ops')], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_specifications_lower_catalog_number', table_name='specifications', postgresql_concurrently=True)
+        op.drop_index('ix_specifications_lower_manufacturer', table_name='specifications', postgresql_concurrently=True)
@@ -0,0 +1,26 @@
+"""orders updated_on index
+
+Revision ID: b4e81f6c2d35
+Revises: 5c7e2a9d4f18
+Create Date: 2026-10-18 18:50:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4e81f6c2d35'
+down_revision = '5c7e2a9d4f18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_orders_updated_on_id', 'orders', ['updated_on', 'id'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_orders_updated_on_id', table_name='orders', postgresql_concurrently=True)
@@ -1,6 +1,8 @@
 from flask import url_for, request, current_app
 
-from app.auth.models import User, PreAllowedUser
+from app.auth.models import (User, PreAllowedUser, Role, Permission,
+                             load_user, invalidate_principal,
+                             principal_cache)
 from app.extensions import db
 
 
@@ -31,6 +33,9 @@ def test_register_and_login(client, database):
                           follow_redirects=True)
     response_data = response.get_data(as_text=True)
     assert 'Conta verificada' in response_data
+    # Committed, not only flushed by the test's session
+    assert db.engine.execute(
+        "SELECT confirmed FROM users WHERE email = 'a@a.com'").scalar()
 
     # TODO: fix this code to consider an authorized and non-authorized user
     # with is needed to access request context
@@ -51,3 +56,72 @@ def test_register_and_login(client, database):
     #     assert response.status_code == 200
     #     assert 'Log Out realizado' in data
     #     assert request.path == '/auth/login'
+
+
+def create_user(email, role_name, confirmed=True):
+    Role.insert_roles()
+    user = User(email=email, password='a', confirmed=confirmed,
+                role=Role.query.filter_by(name=role_name).first())
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def test_load_user_is_cached(database, sql_statements):
+    user_id = create_user('a@a.com', 'User').id
+    principal = load_user(str(user_id))
+    assert principal.email == 'a@a.com'
+    assert principal.confirmed
+    assert principal.can(Permission.VIEW)
+    assert not principal.can(Permission.VIEW | Permission.EDIT)
+    assert not principal.is_administrator()
+
+    del sql_statements[:]
+    assert load_user(str(user_id)) is principal
+    assert sql_statements == []
+    assert load_user('0') is None
+
+
+def test_cached_principal_follows_user_and_role_changes(app, database):
+    user = create_user('a@a.com', 'User')
+    assert not load_user(str(user.id)).can(Permission.EDIT)
+
+    user.role = Role.query.filter_by(name='Staff').first()
+    db.session.commit()
+    assert load_user(str(user.id)).can(Permission.EDIT)
+
+    user.role.permissions = Permission.VIEW
+    db.session.commit()
+    assert not load_user(str(user.id)).can(Permission.EDIT)
+
+    # Changes made by other processes are seen once the TTL expires
+    db.session.execute(User.__table__.update().values(confirmed=False))
+    db.session.commit()
+    assert load_user(str(user.id)).confirmed
+    app.config['PRINCIPAL_CACHE_TTL'] = 0
+    assert not load_user(str(user.id)).confirmed
+
+
+def test_principal_cache_is_bounded(app, database):
+    app.config['PRINCIPAL_CACHE_SIZE'] = 2
+    invalidate_principal()
+    first, second, third = (create_user(email, 'User').id
+                            for email in ('a@a.com', 'b@b.com', 'c@c.com'))
+    load_user(str(first))
+    load_user(str(second))
+    load_user(str(first))
+    load_user(str(third))
+    assert list(principal_cache) == [first, third]
+
+
+def test_permission_checks_do_not_query(client, sql_statements):
+    create_user('a@a.com', 'User')
+    client.post(url_for('auth.login'), data={
+        'email': 'a@a.com',
+        'password': 'a',
+    })
+    assert client.get(url_for('main.purchase_product')).status_code == 403
+
+    del sql_statements[:]
+    assert client.get(url_for('main.purchase_product')).status_code == 403
+    assert sql_statements == []
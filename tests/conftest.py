@@ -1,5 +1,6 @@
 
 import pytest
+from sqlalchemy import event
 
 from config import TestConfig
 from app import create_app
@@ -27,3 +28,16 @@ def database(app):
 def client(app, database):
     test_client = app.test_client(use_cookies=True)
     yield test_client
+
+
+@pytest.fixture(scope='function')
+def sql_statements(database):
+    """List of the SQL statements executed while the test runs"""
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    yield statements
+    event.remove(db.engine, 'before_cursor_execute', record)
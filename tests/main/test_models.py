@@ -1,3 +1,4 @@
+import threading
 from datetime import datetime
 
 import pytest
@@ -7,7 +8,9 @@ from app.extensions import db
 
 from app.auth.models import User
 from app.main.models import (
-    Base, Product, Specification, Stock, StockProduct, Order, OrderItem)
+    Base, Product, Specification, Stock, StockProduct, Order, OrderItem,
+    Transaction)
+from app.main import services as svc
 
 
 class TestBase():
@@ -118,6 +121,107 @@ class Test_Stock():
         Stock.insert_main_stock()
         assert len(Stock.query.all()) is 1
 
+    def test_add_merges_same_lot(self, database):
+        stock = Stock(name='Stock').create()
+        product = Product(name='Product')
+        stock.add(product, 'lot', datetime.utcnow().date(), 2)
+        stock.add(product, 'lot', datetime.utcnow().date(), 3)
+        stock.add(product, 'other lot', datetime.utcnow().date(), 1)
+        db.session.commit()
+        assert len(StockProduct.query.all()) == 2
+        assert stock.get_in_stock(product, 'lot').amount == 5
+        assert stock.get_in_stock(product, 'missing lot') is None
+
+    def test_add_many_upserts_lots(self, database):
+        stock = Stock(name='Stock').create()
+        product = Product(name='Product').create()
+        today = datetime.utcnow().date()
+        stock.add(product, 'lot', today, 2)
+        db.session.commit()
+        existing = stock.get_in_stock(product, 'lot')
+        stock.add_many([
+            (product.id, 'lot', today, 3),
+            (product.id, 'new lot', today, 4),
+            (product.id, 'new lot', today, 5),
+        ])
+        db.session.commit()
+        assert len(StockProduct.query.all()) == 2
+        assert existing.amount == 5
+        assert stock.get_in_stock(product, 'new lot').amount == 9
+        assert len(stock.stock_products) == 2
+
+    def test_get_in_stock_is_scoped_to_stock(self, database):
+        stock_1 = Stock(name='Stock 1').create()
+        stock_2 = Stock(name='Stock 2').create()
+        product = Product(name='Product')
+        stock_1.add(product, 'lot', datetime.utcnow().date(), 2)
+        db.session.commit()
+        assert stock_1.get_in_stock(product, 'lot') is not None
+        assert stock_2.get_in_stock(product, 'lot') is None
+        assert not stock_2.has_enough(product, 'lot', 1)
+
+    def test_subtract(self, database):
+        stock = Stock(name='Stock').create()
+        product = Product(name='Product')
+        stock.add(product, 'lot', datetime.utcnow().date(), 2)
+        db.session.commit()
+        with pytest.raises(ValueError, match=r'Not enough'):
+            stock.subtract(product, 'lot', 3)
+        stock.subtract(product, 'lot', 2)
+        db.session.commit()
+        assert stock.get_in_stock(product, 'lot').amount == 0
+
+    def test_subtract_fefo(self, database):
+        stock = Stock(name='Stock').create()
+        product = Product(name='Product')
+        stock.add(product, 'late', datetime(2030, 1, 1).date(), 5)
+        stock.add(product, 'early', datetime(2020, 1, 1).date(), 3)
+        stock.add(product, 'no date', None, 10)
+        db.session.commit()
+        with pytest.raises(ValueError, match=r'Not enough'):
+            stock.subtract_fefo(product, 19)
+        taken = stock.subtract_fefo(product, 6)
+        db.session.commit()
+        assert taken == [('early', 3), ('late', 3)]
+        assert stock.get_in_stock(product, 'early').amount == 0
+        assert stock.get_in_stock(product, 'late').amount == 2
+        assert stock.get_in_stock(product, 'no date').amount == 10
+
+    def test_concurrent_subtract_never_goes_negative(self, app, database):
+        stock = Stock(name='Stock').create()
+        product = Product(name='Product')
+        stock.add(product, 'lot', datetime.utcnow().date(), 50)
+        db.session.commit()
+        stock_id, product_id = stock.id, product.id
+        db.session.remove()
+
+        workers = 10
+        barrier = threading.Barrier(workers)
+        succeeded = []
+
+        def consume():
+            with app.app_context():
+                stock = Stock.query.get(stock_id)
+                product = Product.query.get(product_id)
+                barrier.wait()
+                try:
+                    svc.consume(stock, product, 'lot', 7, None)
+                    succeeded.append(True)
+                except ValueError:
+                    pass
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=consume) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(succeeded) == 7
+        assert StockProduct.query.one().amount == 1
+        assert len(Transaction.query.all()) == 7
+
 
 class Test_StockProduct():
     def test_lot_number_not_null(self, database):
@@ -287,3 +391,64 @@ class Test_Transaction_Relationships():
 
     def test_stock(self, database):
         pass
+
+
+class Test_KeysetPagination():
+    def test_walks_pages_in_both_directions(self, database):
+        same_date = datetime(2020, 1, 1)
+        for i in range(5):
+            db.session.add(Order(order_date=datetime(2020, 1, 2 + i)))
+        for i in range(2):
+            db.session.add(Order(order_date=same_date))
+        db.session.commit()
+        expected = [o.id for o in Order.query.order_by(
+            Order.order_date.desc(), Order.id.desc())]
+
+        pages = [Order.query.keyset_page(Order.order_date, per_page=3)]
+        while pages[-1].next_cursor:
+            pages.append(Order.query.keyset_page(
+                Order.order_date, after=pages[-1].next_cursor, per_page=3))
+        assert [o.id for p in pages for o in p.items] == expected
+        assert [len(p.items) for p in pages] == [3, 3, 1]
+        assert pages[0].prev_cursor is None
+
+        previous = Order.query.keyset_page(
+            Order.order_date, before=pages[2].prev_cursor, per_page=3)
+        assert previous.items == pages[1].items
+        first = Order.query.keyset_page(
+            Order.order_date, before=previous.prev_cursor, per_page=3)
+        assert first.items == pages[0].items
+        assert first.prev_cursor is None
+
+    def test_malformed_cursor(self, database):
+        with pytest.raises(ValueError):
+            Order.query.keyset_page(Order.order_date, after='not a cursor')
+
+
+class Test_DisplayRelations():
+    def test_list_queries_load_relations_up_front(self, sql_statements):
+        stock = Stock(name='Stock')
+        for i in range(3):
+            user = User(email=f'user{i}@user.com')
+            product = Product(name=f'Product {i}',
+                              specifications=[Specification()])
+            db.session.add(Order(user=user))
+            db.session.add(StockProduct(stock=stock, product=product,
+                                        lot_number='lot', amount=1))
+            db.session.add(Transaction(user=user, product=product,
+                                       stock=stock, amount=1,
+                                       category=Transaction.ADD))
+        db.session.commit()
+        db.session.expunge_all()
+        del sql_statements[:]
+
+        transactions = Transaction.query.with_display_relations().all()
+        [(t.product.name, t.user.email) for t in transactions]
+        orders = Order.query.with_display_relations().all()
+        [o.user.email for o in orders]
+        products = Product.query.with_display_relations().all()
+        [len(p.specifications) for p in products]
+        stock_products = StockProduct.query.with_display_relations().all()
+        [sp.product.name for sp in stock_products]
+
+        assert len(sql_statements) == 5
@@ -0,0 +1,57 @@
+from sqlalchemy import func
+
+from app.extensions import db
+from app.auth.models import User
+from app.main.models import (Product, Specification, Order, OrderItem,
+                             StockProduct, Transaction)
+from app.main.seed import seed, copy_rows
+
+
+def foreign_keys_count():
+    return db.session.execute(
+        "SELECT count(*) FROM pg_constraint WHERE contype = 'f'").scalar()
+
+
+def test_seed_is_consistent_and_reproducible(database):
+    foreign_keys = foreign_keys_count()
+
+    counts = seed(products=20, users=5, orders=10, transactions=300)
+
+    assert counts['users'] == User.query.count() == 5
+    assert User.query.filter_by(stock_mail_alert=True).count() == 0
+    assert counts['products'] == Product.query.count() == 20
+    assert counts['specifications'] == Specification.query.count() >= 20
+    assert counts['orders'] == Order.query.count() == 10
+    assert counts['order_items'] == OrderItem.query.count() == \
+        StockProduct.query.count()
+    assert Transaction.query.filter_by(
+        category=Transaction.SUB).count() == 300
+    assert foreign_keys_count() == foreign_keys
+
+    # Lots hold what the ledger says
+    signed_amount = func.sum(db.case(
+        [(Transaction.category == Transaction.ADD, Transaction.amount)],
+        else_=-Transaction.amount))
+    ledger = dict(db.session.query(
+        Transaction.lot_number, signed_amount).group_by(
+        Transaction.lot_number))
+    assert ledger == dict(db.session.query(
+        StockProduct.lot_number, StockProduct.amount))
+    assert min(ledger.values()) >= 0
+
+    # Seeding again adds the same amount of data, under new names and ids
+    assert seed(products=20, users=5, orders=10, transactions=300) == counts
+    assert Product.query.count() == 40
+    # Sequences follow the seeded ids
+    Product(name='Product').create()
+
+
+def test_copy_rows_escapes_text(database):
+    names = ['tab\there', 'line\nbreak', 'back\\slash\\N', 'carriage\rreturn']
+    cursor = db.session.connection().connection.cursor()
+
+    assert copy_rows(cursor, 'products', ['name', 'stock_minimum'],
+                     ((name, 0) for name in names)) == 4
+
+    assert sorted(name for name, in db.session.query(Product.name)) == \
+        sorted(names)
@@ -0,0 +1,384 @@
+from datetime import date
+
+import pytest
+from sqlalchemy import event
+
+from app.extensions import db
+
+from app.auth.models import User, Role
+from app.main import services as svc
+from app.main.models import (
+    Order, OrderItem, Product, Specification, Stock, StockProduct,
+    Transaction, StockAlert, OutboxEmail)
+
+
+@pytest.fixture
+def commits(database):
+    counter = []
+    session = db.session()
+
+    def count(_):
+        counter.append(True)
+
+    event.listen(session, 'after_commit', count)
+    yield counter
+    event.remove(session, 'after_commit', count)
+
+
+class Test_GetProductsInStock():
+    def test_totals_and_below_minimum(self, database):
+        stock = Stock(name='Stock').create()
+        other_stock = Stock(name='Other Stock').create()
+        product_a = Product(name='A', stock_minimum=10)
+        product_b = Product(name='B', stock_minimum=1)
+        stock.add(product_a, 'lot_1', date.today(), 3)
+        stock.add(product_a, 'lot_2', date.today(), 4)
+        stock.add(product_b, 'lot_1', date.today(), 5)
+        stock.add(product_b, 'lot_2', date.today(), 1)
+        other_stock.add(product_b, 'lot_1', date.today(), 100)
+        db.session.commit()
+        stock.subtract(product_b, 'lot_2', 1)
+        db.session.commit()
+
+        products = svc.get_products_in_stock(stock)
+
+        assert [p.name for p in products] == ['A', 'B']
+        assert products[0].total == 7
+        assert products[0].below_minimum is True
+        assert products[1].total == 5
+        assert products[1].below_minimum is False
+        # Only the lots of this stock with units left
+        assert [(lot.lot_number, lot.amount) for lot in products[0].lots] == \
+            [('lot_1', 3), ('lot_2', 4)]
+        assert [(lot.lot_number, lot.amount) for lot in products[1].lots] == \
+            [('lot_1', 5)]
+        assert stock.total(product_a) == 7
+        assert other_stock.total(product_a) == 0
+
+
+class Test_GetManufacturersByLotNumber():
+    def test_batched_and_cached(self, app, sql_statements):
+        product = Product(name='Product')
+        spec_1 = Specification(product=product, manufacturer='Man 1',
+                               catalog_number='1')
+        spec_2 = Specification(product=product, manufacturer=None,
+                               catalog_number='2')
+        Order(order_items=[
+            OrderItem(item=spec_1, lot_number='lot_1'),
+            OrderItem(item=spec_2, lot_number='lot_2'),
+        ]).create()
+        del sql_statements[:]
+
+        with app.test_request_context():
+            manufacturers = svc.get_manufacturers_by_lot_number(
+                ['lot_1', 'lot_2', 'unknown'])
+            assert svc.get_manufacturer_by_lot_number('lot_1') == 'Man 1'
+
+        assert manufacturers == {'lot_1': 'Man 1', 'lot_2': '', 'unknown': ''}
+        assert len(sql_statements) == 1
+
+
+class Test_ReceiveOrder():
+    def test_commits_once(self, database, commits):
+        stock = Stock(name='Stock').create()
+        spec = Specification(product=Product(name='Product'), units=10)
+        spec.create()
+        order = Order(order_items=[
+            OrderItem(item=spec, amount=2, lot_number='lot_1'),
+            OrderItem(item=spec, amount=1, lot_number='lot_2'),
+        ])
+        del commits[:]
+
+        svc.receive_order(order, stock)
+
+        assert len(commits) == 1
+        assert stock.total(spec.product) == 30
+        assert len(Transaction.query.all()) == 2
+        assert all(item.added_to_stock for item in order.order_items)
+
+
+class Test_Consume():
+    def test_commits_once(self, database, commits):
+        stock = Stock(name='Stock').create()
+        product = Product(name='Product')
+        stock.add(product, 'lot', date.today(), 5)
+        db.session.commit()
+        del commits[:]
+
+        svc.consume(stock, product, 'lot', 2, None)
+
+        assert len(commits) == 1
+        assert stock.total(product) == 3
+        assert Transaction.query.one().category == Transaction.SUB
+
+    def test_rolls_back_when_not_enough(self, database, commits):
+        stock = Stock(name='Stock').create()
+        product = Product(name='Product')
+        stock.add(product, 'lot', date.today(), 5)
+        db.session.commit()
+        del commits[:]
+
+        with pytest.raises(ValueError):
+            svc.consume(stock, product, 'lot', 6, None)
+
+        assert not commits
+        assert stock.total(product) == 5
+        assert not Transaction.query.all()
+
+
+class Test_ConsumeFefo():
+    def test_one_transaction_per_lot(self, database, commits):
+        stock = Stock(name='Stock').create()
+        product = Product(name='Product')
+        stock.add(product, 'lot_1', date(2020, 1, 1), 2)
+        stock.add(product, 'lot_2', date(2021, 1, 1), 2)
+        stock.add(product, 'lot_3', date(2022, 1, 1), 2)
+        db.session.commit()
+        del commits[:]
+
+        taken = svc.consume_fefo(stock, product, 3, None)
+
+        assert len(commits) == 1
+        assert taken == [('lot_1', 2), ('lot_2', 1)]
+        transactions = Transaction.query.order_by(Transaction.id).all()
+        assert [(t.lot_number, t.amount) for t in transactions] == taken
+
+
+class Test_ImportCatalog():
+    def test_skips_existing_and_reports_errors(self, database, commits):
+        product = Product(name='A', stock_minimum=5)
+        Specification(product=product, manufacturer='Man',
+                      catalog_number='1').create()
+        Specification(product=product).create()
+        del commits[:]
+        rows = [
+            {'reativo': 'A', 'fabricante': 'Man', 'catalogo': '1'},
+            {'reativo': 'A', 'fabricante': '', 'catalogo': '',
+             'estoque_minimo': '10'},
+            {'reativo': 'A', 'fabricante': 'Man', 'catalogo': '2'},
+            {'reativo': '', 'fabricante': 'Man'},
+            {'reativo': 'B', 'unidade_de_estoque': '0'},
+            {'reativo': 'B', 'unidade_de_estoque': '3',
+             'estoque_minimo': '2'},
+            {'reativo': 'B', 'unidade_de_estoque': '4'},
+            {'reativo': 'C', 'estoque_minimo': 'many'},
+            {'reativo': 'C', 'unidade_de_estoque': '1.5'},
+        ]
+        batches = []
+
+        result = svc.import_catalog(rows, batch_size=3,
+                                    progress=batches.append)
+
+        assert [batch.rows for batch in batches] == [3, 6, 9]
+        assert len(commits) == 3
+        assert (result.rows, result.products, result.specifications) == \
+            (9, 1, 2)
+        assert result.errors == [
+            (5, 'reativo is required'),
+            (6, 'unidade_de_estoque must be between 1 and 2147483647'),
+            (9, 'estoque_minimo is not a number: many'),
+            (10, 'unidade_de_estoque is not an integer: 1.5'),
+        ]
+        products = Product.query.order_by(Product.name).all()
+        assert [(p.name, p.stock_minimum) for p in products] == \
+            [('A', 5), ('B', 2)]
+        assert sorted((s.catalog_number or '', s.units)
+                      for s in products[0].specifications) == \
+            [('', 1), ('1', 1), ('2', 1)]
+        assert [s.units for s in products[1].specifications] == [3]
+
+
+class Test_Cart():
+    def test_add_get_and_clear(self, database):
+        user = User(email='user@user.com')
+        other_user = User(email='other@user.com')
+        db.session.add_all([user, other_user])
+        spec = Specification(product=Product(name='Product')).create()
+
+        svc.add_order_item_to_cart(user, OrderItem(
+            item_id=spec.id, amount=2, lot_number='lot_1',
+            expiration_date=date(2030, 1, 1)))
+        svc.add_order_item_to_cart(user, OrderItem(
+            item_id=spec.id, amount=1, lot_number='lot_2'))
+        svc.add_order_item_to_cart(other_user, OrderItem(
+            item_id=spec.id, amount=5, lot_number='lot_3'))
+
+        cart = svc.get_cart(user)
+        assert [(i.item_id, i.amount, i.lot_number, i.expiration_date)
+                for i in cart] == [(spec.id, 2, 'lot_1', date(2030, 1, 1)),
+                                   (spec.id, 1, 'lot_2', None)]
+        assert all(i not in db.session for i in cart)
+
+        svc.clear_cart(user)
+        assert svc.get_cart(user) == []
+        assert len(svc.get_cart(other_user)) == 1
+
+    def test_specifications_loaded_in_one_query(self, database,
+                                                sql_statements):
+        user = User(email='user@user.com')
+        db.session.add(user)
+        for name in ('A', 'B', 'C'):
+            spec = Specification(product=Product(name=name)).create()
+            svc.add_order_item_to_cart(user, OrderItem(
+                item_id=spec.id, amount=1, lot_number='lot'))
+        user_id = user.id
+        db.session.expunge_all()
+        user = User.query.get(user_id)
+        del sql_statements[:]
+
+        cart = svc.get_cart(user)
+
+        assert [i.item.product.name for i in cart] == ['A', 'B', 'C']
+        assert len(sql_statements) == 2
+
+
+class Test_Search():
+    def test_prefix_matches_first(self, database):
+        for name in ('Acid', 'Base acid', 'Acetone', 'Water', '50% acid'):
+            Product(name=name).create()
+
+        assert [name for _, name in svc.search_products('ac')] == \
+            ['Acetone', 'Acid', '50% acid', 'Base acid']
+        assert [name for _, name in svc.search_products('AC', limit=3)] == \
+            ['Acetone', 'Acid', '50% acid']
+        assert [name for _, name in svc.search_products('0%')] == \
+            ['50% acid']
+        assert len(svc.search_products('')) == 5
+
+    def test_stock_products_by_name_or_lot(self, app, database):
+        stock = Stock(name='Stock').create()
+        acid, water = Product(name='Acid'), Product(name='Water')
+        stock.add(acid, 'W-1', date(2030, 1, 1), 1)
+        stock.add(water, 'A-1', date(2030, 1, 1), 2)
+        stock.add(water, 'A-2', date(2030, 1, 1), 1)
+        db.session.commit()
+        stock.subtract(water, 'A-2', 1)
+        db.session.commit()
+
+        with app.test_request_context():
+            results = svc.search_stock_products(stock, 'a')
+            assert [label.split(' | ')[:2] for _, label in results] == [
+                ['Acid', 'Lote: W-1'], ['Water', 'Lote: A-1']]
+            assert svc.get_stock_product_label(stock, results[1][0]) == \
+                results[1][1]
+            empty_lot = StockProduct.query.filter_by(lot_number='A-2').one()
+            assert svc.get_stock_product_label(stock, empty_lot.id) is None
+
+        assert svc.search_products_in_stock(stock, '') == [
+            (acid.id, 'Acid | Quantidade: 1'),
+            (water.id, 'Water | Quantidade: 2')]
+
+    def test_specifications(self, database, sql_statements):
+        spec = Specification(product=Product(name='Acid'),
+                             manufacturer='Sigma', catalog_number='A1')
+        spec.create()
+
+        label = 'Acid | Sigma | Catálogo: A1 | 1 unidades/produto'
+        assert svc.search_specifications('sigma') == [(spec.id, label)]
+        assert svc.search_specifications('ACI') == [(spec.id, label)]
+        assert svc.search_specifications('a1') == [(spec.id, label)]
+        assert svc.search_specifications('water') == []
+        assert svc.get_specification_label(spec.id + 1) is None
+        del sql_statements[:]
+        assert svc.get_specification_label(spec.id) == label
+        assert len(sql_statements) == 1
+
+
+class Test_SearchCatalog():
+    def names(self, text):
+        return [name for _, name in svc.search_catalog(text)]
+
+    def test_accents_inflections_and_specifications(self, database):
+        acid = Product(name='Ácido Sulfúrico')
+        Specification(product=acid, manufacturer='Sigma',
+                      catalog_number='S-1234').create()
+        Product(name='Sulfato de Cobre').create()
+        Product(name='Água destilada', specifications=[
+            Specification(manufacturer='Ácidos Brasil')]).create()
+
+        assert self.names('acido') == ['Ácido Sulfúrico', 'Água destilada']
+        assert self.names('ÁCIDOS sulf') == ['Ácido Sulfúrico']
+        assert sorted(self.names('sulf')) == \
+            ['Sulfato de Cobre', 'Ácido Sulfúrico']
+        assert self.names('sigm') == ['Ácido Sulfúrico']
+        assert self.names('1234') == ['Ácido Sulfúrico']
+        assert self.names('agua') == ['Água destilada']
+        assert self.names('+&|') == sorted(
+            ['Ácido Sulfúrico', 'Sulfato de Cobre', 'Água destilada'])
+
+    def test_vector_follows_specification_changes(self, database):
+        spec = Specification(product=Product(name='Reagent'),
+                             manufacturer='Sigma').create()
+        assert self.names('sigma') == ['Reagent']
+
+        spec.manufacturer = 'Merck'
+        db.session.commit()
+        assert self.names('sigma') == []
+        assert self.names('merck') == ['Reagent']
+
+        spec.delete()
+        assert self.names('merck') == []
+        assert self.names('reagent') == ['Reagent']
+
+
+class Test_StockAlerts():
+    def test_only_touched_products_crossing_the_minimum(self, database):
+        stock = Stock(name='Stock').create()
+        product = Product(name='Product', stock_minimum=5)
+        untouched = Product(name='Untouched', stock_minimum=100)
+        stock.add(product, 'lot', date.today(), 10)
+        stock.add(untouched, 'lot', date.today(), 1)
+        db.session.commit()
+
+        svc.consume(stock, product, 'lot', 5, None)
+        assert not StockAlert.query.all()
+
+        svc.consume(stock, product, 'lot', 1, None)
+        alert = StockAlert.query.one()
+        assert (alert.product, alert.amount, alert.stock_minimum) == (
+            product, 4, 5)
+        created_on = alert.created_on
+
+        svc.consume_fefo(stock, product, 1, None)
+        db.session.expire_all()
+        alert = StockAlert.query.one()
+        assert (alert.amount, alert.created_on) == (3, created_on)
+
+        # Back at the minimum
+        stock.add(product, 'lot', date.today(), 2)
+        svc.evaluate_stock_alerts(stock, [product.id])
+        db.session.commit()
+        assert not StockAlert.query.all()
+
+    def test_one_digest_per_recipient_after_the_window(self, app, database):
+        Role.insert_roles()
+        administrator = Role.query.filter_by(name='Administrator').first()
+        for email, role, alert in [('a@a.com', administrator, True),
+                                   ('b@a.com', administrator, True),
+                                   ('c@a.com', administrator, False),
+                                   ('d@a.com', None, True)]:
+            db.session.add(User(email=email, role=role,
+                                stock_mail_alert=alert))
+        stock = Stock(name='Stock').create()
+        products = [Product(name=name, stock_minimum=5) for name in 'BA']
+        for product in products:
+            stock.add(product, 'lot', date.today(), 5)
+        db.session.commit()
+        assert User.get_stock_alert_emails() == ['a@a.com', 'b@a.com']
+
+        for product in products:
+            svc.consume(stock, product, 'lot', 1, None)
+        assert svc.queue_stock_alert_digests() == 0
+        assert not OutboxEmail.query.all()
+
+        app.config['STOCK_ALERT_WINDOW'] = 0
+        assert svc.queue_stock_alert_digests() == 2
+        emails = OutboxEmail.query.order_by(OutboxEmail.recipients).all()
+        assert [email.recipients for email in emails] == ['a@a.com',
+                                                          'b@a.com']
+        assert emails[0].body.index('- A: estoque = 4') < \
+            emails[0].body.index('- B: estoque = 4')
+
+        # Sent alerts are not sent again while the products stay below
+        svc.consume(stock, products[0], 'lot', 1, None)
+        assert svc.queue_stock_alert_digests() == 0
@@ -0,0 +1,317 @@
+import gzip
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+
+import pytest
+import xlsxwriter
+from sqlalchemy.orm import Session
+from werkzeug.datastructures import MIMEAccept
+
+from app.extensions import db
+
+from app.auth.models import User
+from app.main import utils
+from app.main.models import Order, Product, Specification
+
+
+class Test_GenerateCsv():
+    def test_yields_header_and_rows_in_chunks(self, database):
+        for name in ('A', 'B', 'C'):
+            db.session.add(Product(name=name,
+                                   specifications=[Specification()]))
+        db.session.commit()
+
+        chunks = list(utils.generate_csv(
+            utils.get_query('products'), chunk_size=2))
+
+        assert len(chunks) == 2
+        lines = ''.join(chunks).splitlines()
+        assert lines[0].startswith('id,reativo,fabricante')
+        assert [line.split(',')[1] for line in lines[1:]] == ['A', 'B', 'C']
+
+    def test_empty_result_yields_header(self, database):
+        chunks = list(utils.generate_csv(utils.get_query('orders')))
+        assert len(chunks) == 1
+        assert chunks[0].startswith('id,data,email_usuario')
+
+    def test_unknown_table(self, database):
+        with pytest.raises(ValueError):
+            utils.get_query('users')
+
+
+class Test_ExportFormats():
+    @pytest.fixture
+    def products(self, database):
+        for name in ('A', 'Ç'):
+            db.session.add(Product(name=name,
+                                   specifications=[Specification()]))
+        db.session.commit()
+
+    def test_ndjson(self, products):
+        lines = ''.join(utils.generate_ndjson(
+            utils.get_query('products'))).splitlines()
+        assert [json.loads(line)['reativo'] for line in lines] == ['A', 'Ç']
+
+    def test_gzip_csv(self, products):
+        data = b''.join(utils.gzip_chunks(
+            utils.generate_csv(utils.get_query('products'))))
+        text = gzip.decompress(data).decode('utf-8')
+        assert text == ''.join(utils.generate_csv(
+            utils.get_query('products')))
+
+    def test_xlsx(self, products):
+        data = b''.join(utils.generate_xlsx(utils.get_query('products')))
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        assert 'xl/worksheets/sheet1.xml' in archive.namelist()
+
+    def test_export_table_headers(self, app, products):
+        with app.test_request_context():
+            response = utils.export_table('products', 'csv.gz')
+            assert response.mimetype == 'application/gzip'
+            assert response.headers['Content-Disposition'] == \
+                'attachment; filename=products.csv.gz'
+            with pytest.raises(ValueError):
+                utils.export_table('products', 'pdf')
+
+    def test_negotiate_export_format(self):
+        def negotiate(header):
+            return utils.negotiate_export_format(MIMEAccept(header))
+        assert negotiate([('*/*', 1)]) == 'csv'
+        assert negotiate([('application/x-ndjson', 1)]) == 'ndjson'
+        assert negotiate([('application/gzip', 1)]) == 'csv.gz'
+        assert negotiate([('text/html', 1)]) == 'csv'
+
+
+class Test_IncrementalExport():
+    @pytest.fixture(autouse=True)
+    def no_lag(self, app):
+        app.config['EXPORT_WATERMARK_LAG'] = 0
+
+    def export(self, since=None):
+        _, chunks, watermark = utils.get_export('orders', 'ndjson', since)
+        notes = [json.loads(line)['observacoes']
+                 for line in ''.join(chunks).splitlines()]
+        return notes, watermark
+
+    def test_only_changed_rows_after_watermark(self, database):
+        user = User(email='user@user.com')
+        first = Order(user=user, notes='first').create()
+        Order(user=user, notes='second').create()
+
+        notes, watermark = self.export()
+        assert sorted(notes) == ['first', 'second']
+
+        Order(user=user, notes='third').create()
+        notes, watermark = self.export(watermark)
+        assert notes == ['third']
+
+        first.notes = 'first updated'
+        db.session.commit()
+        notes, watermark = self.export(watermark)
+        assert notes == ['first updated']
+
+        notes, next_watermark = self.export(watermark)
+        assert notes == []
+        assert next_watermark == watermark
+
+    def test_rows_committed_late_are_not_skipped(self, database):
+        user = User(email='user@user.com')
+        Order(user=user, notes='first').create()
+        _, watermark = self.export()
+
+        # A transaction writes a row, then another commits a newer one
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        late = Session(bind=connection)
+        late.add(Order(user_id=user.id, notes='late'))
+        late.flush()
+        Order(user=user, notes='newer').create()
+
+        notes, watermark = self.export(watermark)
+        assert notes == []
+
+        transaction.commit()
+        late.close()
+        connection.close()
+        notes, watermark = self.export(watermark)
+        assert notes == ['late', 'newer']
+
+    def test_watermark_lag(self, app, database):
+        app.config['EXPORT_WATERMARK_LAG'] = 60
+        Order(user=User(email='user@user.com'), notes='first').create()
+        notes, watermark = self.export()
+        assert notes == ['first']
+        assert watermark is None
+
+    def test_tables_without_timestamps(self, database):
+        _, _, watermark = utils.get_export('products')
+        assert watermark is None
+        with pytest.raises(ValueError):
+            utils.get_export('products', since='2020-01-01T00:00:00.0_1')
+
+
+class Test_ExportBundle():
+    def test_tables_share_one_snapshot(self, database):
+        user = User(email='user@user.com')
+        Order(user=user, notes='first').create()
+        Product(name='A', specifications=[Specification()]).create()
+
+        chunks = utils.generate_bundle(['products', 'orders'])
+        data = next(chunks)
+        Order(user=user, notes='second').create()
+        Product(name='B', specifications=[Specification()]).create()
+        data += b''.join(chunks)
+
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        assert sorted(archive.namelist()) == [
+            'manifest.json', 'orders.csv', 'products.csv']
+        manifest = json.loads(archive.read('manifest.json'))
+        assert manifest['tables'] == {
+            'products': {'file': 'products.csv', 'rows': 1},
+            'orders': {'file': 'orders.csv', 'rows': 1},
+        }
+        assert 'snapshot_at' in manifest
+        orders = archive.read('orders.csv').decode().splitlines()
+        assert len(orders) == 2 and 'first' in orders[1]
+
+    def test_repeated_tables(self, database):
+        data = b''.join(utils.generate_bundle(['orders', 'orders']))
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        assert sorted(archive.namelist()) == ['manifest.json', 'orders.csv']
+
+    def test_unknown_table(self, database):
+        with pytest.raises(ValueError):
+            utils.generate_bundle(['orders', 'users'])
+
+
+class Test_ExportJobs():
+    @pytest.fixture
+    def cache_dir(self, app, tmp_path):
+        app.config['EXPORT_CACHE_DIR'] = str(tmp_path)
+        yield tmp_path
+
+    def wait(self, job_id):
+        for _ in range(100):
+            status = utils.get_export_job_status(job_id)
+            if status != 'running':
+                return status
+            time.sleep(0.05)
+
+    def test_cached_until_data_changes(self, database, cache_dir):
+        Product(name='A', specifications=[Specification()]).create()
+
+        job_id = utils.start_export_job('products')
+        assert self.wait(job_id) == 'ready'
+        assert utils.start_export_job('products') == job_id
+        with open(utils.get_export_job_path(job_id)) as export_file:
+            assert len(export_file.read().splitlines()) == 2
+
+        Product(name='B', specifications=[Specification()]).create()
+        new_job_id = utils.start_export_job('products')
+        assert new_job_id != job_id
+        assert self.wait(new_job_id) == 'ready'
+        # The previous result is kept for EXPORT_RESULT_GRACE seconds
+        assert utils.get_export_job_status(job_id) == 'ready'
+
+    def test_data_version_changes_on_update(self, database):
+        user = User(email='user@user.com')
+        order = Order(user=user, notes='first').create()
+        product = Product(name='A').create()
+        versions = {utils.get_data_version(table)
+                    for table in ('orders', 'products')}
+
+        order.notes = 'updated'
+        product.name = 'B'
+        db.session.commit()
+
+        assert versions.isdisjoint(utils.get_data_version(table)
+                                   for table in ('orders', 'products'))
+
+    def test_data_version_changes_on_late_commit(self, database):
+        Product(name='A').create()
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        connection.execute("UPDATE products SET name = 'B'")
+        version = utils.get_data_version('products')
+        Product(name='C').create()
+        newer_version = utils.get_data_version('products')
+        assert newer_version != version
+
+        transaction.commit()
+        connection.close()
+        assert utils.get_data_version('products') != newer_version
+
+    def test_superseded_results_removed_after_grace(self, cache_dir):
+        now = time.time()
+        paths = []
+        for version, age in (('0', 300), ('1', 200), ('2', 50)):
+            path = cache_dir / 'products-{}.csv'.format(version * 16)
+            path.touch()
+            os.utime(path, (now - age, now - age))
+            paths.append(path)
+        (cache_dir / 'products-3333333333333333.csv.gz').touch()
+
+        utils.remove_superseded_exports('products', 'csv', str(cache_dir),
+                                        grace=100)
+
+        assert sorted(path.name for path in cache_dir.iterdir()) == [
+            paths[1].name, paths[2].name,
+            'products-3333333333333333.csv.gz']
+
+    def test_running_job_kept_alive(self, cache_dir):
+        part = cache_dir / 'products-0123456789abcdef.csv.part'
+        part.touch()
+        os.utime(part, (0, 0))
+        stop = threading.Event()
+        thread = threading.Thread(target=utils.keep_export_job_alive,
+                                  args=(str(part), stop, 0.01))
+        thread.start()
+        time.sleep(0.1)
+        stop.set()
+        thread.join()
+        assert time.time() - part.stat().st_mtime < 1
+
+    def test_stale_job_failed(self, app, database, cache_dir):
+        job_id = 'products-0123456789abcdef.csv'
+        part = cache_dir / (job_id + '.part')
+        part.touch()
+        assert utils.get_export_job_status(job_id) == 'running'
+        app.config['EXPORT_JOB_TIMEOUT'] = -1
+        assert utils.get_export_job_status(job_id) == 'failed'
+
+    def test_invalid_jobs(self, database, cache_dir):
+        with pytest.raises(ValueError):
+            utils.start_export_job('users')
+        with pytest.raises(ValueError):
+            utils.start_export_job('products', 'pdf')
+        with pytest.raises(ValueError):
+            utils.get_export_job_status('../products-0123456789abcdef.csv')
+        assert utils.get_export_job_status(
+            'products-0123456789abcdef.csv') is None
+
+
+class Test_ReadTableRows():
+    def test_csv_and_xlsx(self, tmp_path):
+        csv_path = tmp_path / 'catalog.csv'
+        csv_path.write_text('﻿reativo,catalogo\nA,1\nB,\n',
+                            encoding='utf-8')
+        xlsx_path = str(tmp_path / 'catalog.xlsx')
+        workbook = xlsxwriter.Workbook(xlsx_path)
+        worksheet = workbook.add_worksheet()
+        for i, row in enumerate([('reativo', 'catalogo'), ('A', 1),
+                                 ('B', None)]):
+            worksheet.write_row(i, 0, row)
+        workbook.close()
+
+        assert list(utils.read_table_rows(str(csv_path))) == [
+            {'reativo': 'A', 'catalogo': '1'},
+            {'reativo': 'B', 'catalogo': ''},
+        ]
+        assert list(utils.read_table_rows(xlsx_path)) == [
+            {'reativo': 'A', 'catalogo': 1},
+            {'reativo': 'B', 'catalogo': None},
+        ]
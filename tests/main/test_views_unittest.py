@@ -303,6 +303,7 @@ class TestInventoryViews(unittest.TestCase):
         prod1 = models.Product(name='Prod1', specifications=[spec1])
         # Add product to stock
         models.Stock.query.first().add(prod1, 'lot1', datetime.date.today(), 10)
+        db.session.commit()
         stock_products = models.StockProduct.query.all()
         # Asserts they were added
         self.assertEqual(len(stock_products), 1)
@@ -319,6 +320,7 @@ class TestInventoryViews(unittest.TestCase):
             greater_amount_data = {
                 'stock_product_id': stock_products[0].id,
                 'amount': 11,
+                'consumer_id': self.user.id,
             }
             res = client.post(url_for('main.consume_product'),
                               data=greater_amount_data,
@@ -331,6 +333,7 @@ class TestInventoryViews(unittest.TestCase):
             sufficient_amount_data = {
                 'stock_product_id': stock_products[0].id,
                 'amount': 9,
+                'consumer_id': self.user.id,
             }
             res = client.post(url_for('main.consume_product'),
                               data=sufficient_amount_data,
@@ -342,3 +345,28 @@ class TestInventoryViews(unittest.TestCase):
             transactions = models.Transaction.query.all()
             self.assertEqual(len(transactions), 1)
             self.assertEqual(transactions[0].amount, 9)
+
+    def test_search_and_validate_stock_products(self):
+        prod1 = models.Product(name='Prod1')
+        models.Stock.query.first().add(prod1, 'lot1', datetime.date.today(), 10)
+        db.session.commit()
+        stock_product = models.StockProduct.query.one()
+        with self.client as client:
+            client.post(url_for('auth.login'), data={
+                'email': 'user@example.com',
+                'password': 'example',
+            }, follow_redirects=True)
+
+            res = client.get(url_for('main.search_stock_products', q='lot'))
+            results = res.get_json()['results']
+            self.assertEqual([r['id'] for r in results], [stock_product.id])
+            self.assertIn('Prod1 | Lote: lot1', results[0]['text'])
+
+            # Ids outside of the search results are rejected
+            res = client.post(url_for('main.consume_product'), data={
+                'stock_product_id': stock_product.id + 1,
+                'amount': 1,
+                'consumer_id': self.user.id,
+            }, follow_redirects=True)
+            self.assertIn('Not a valid choice', res.get_data(as_text=True))
+            self.assertEqual(models.Transaction.query.all(), [])
@@ -0,0 +1,172 @@
+import socket
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.extensions import db, mail
+from app.main.models import OutboxEmail
+from app.utils.email import send_email, deliver_outbox_batch, run_mail_worker
+
+controller = pytest.importorskip('aiosmtpd.controller')
+
+
+class Handler:
+    """Records the delivered emails, refusing the recipients in `refuse`"""
+
+    def __init__(self):
+        self.messages = []
+        self.sessions = set()
+        self.refuse = set()
+
+    async def handle_RCPT(self, server, session, envelope, address,
+                          rcpt_options):
+        if address in self.refuse:
+            return '550 Mailbox unavailable'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.sessions.add(id(session))
+        self.messages.append((envelope.rcpt_tos, envelope.content))
+        return '250 Message accepted for delivery'
+
+
+@pytest.fixture
+def smtp_handler(app):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    handler = Handler()
+    server = controller.Controller(handler, hostname='127.0.0.1', port=port)
+    server.start()
+    app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port,
+                      MAIL_USE_TLS=False, MAIL_SUPPRESS_SEND=False)
+    mail.init_app(app)
+    yield handler
+    server.stop()
+
+
+def queue_email(recipient):
+    with db.get_app().test_request_context():
+        send_email(recipients=[recipient], subject='Confirme sua conta',
+                   template='auth/email/confirm', token='token')
+
+
+def test_send_email_only_queues(database, smtp_handler):
+    queue_email('a@a.com')
+    db.session.rollback()
+    assert OutboxEmail.query.count() == 0
+
+    queue_email('a@a.com')
+    db.session.commit()
+    email = OutboxEmail.query.one()
+    assert email.recipients == 'a@a.com'
+    assert 'auth/confirm/token' in email.body
+    assert email.sent_on is None
+    assert smtp_handler.messages == []
+
+
+def test_worker_sends_batches_over_one_connection(database, smtp_handler):
+    for number in range(5):
+        queue_email(f'{number}@a.com')
+    db.session.commit()
+
+    run_mail_worker(batch_size=2, interval=0, once=True)
+
+    assert [rcpt_tos for rcpt_tos, _ in smtp_handler.messages] == [
+        [f'{number}@a.com'] for number in range(5)]
+    assert len(smtp_handler.sessions) == 1
+    assert OutboxEmail.query.filter(OutboxEmail.sent_on.is_(None)).count() \
+        == 0
+
+    # Sent emails are not sent again
+    run_mail_worker(batch_size=2, interval=0, once=True)
+    assert len(smtp_handler.messages) == 5
+
+
+def test_refused_emails_are_retried_with_backoff(app, database,
+                                                  smtp_handler):
+    smtp_handler.refuse.add('b@a.com')
+    queue_email('a@a.com')
+    queue_email('b@a.com')
+    db.session.commit()
+
+    run_mail_worker(batch_size=10, interval=0, once=True)
+    refused = OutboxEmail.query.filter_by(recipients='b@a.com').one()
+    assert refused.sent_on is None
+    assert refused.attempts == 1
+    assert 'Mailbox unavailable' in refused.last_error
+    first_delay = refused.next_attempt_on - datetime.utcnow()
+    assert timedelta(0) < first_delay <= timedelta(
+        seconds=app.config['MAIL_RETRY_DELAY'])
+
+    # Not due yet
+    run_mail_worker(batch_size=10, interval=0, once=True)
+    assert refused.attempts == 1
+
+    refused.next_attempt_on = datetime.utcnow()
+    db.session.commit()
+    run_mail_worker(batch_size=10, interval=0, once=True)
+    assert refused.attempts == 2
+    assert refused.next_attempt_on - datetime.utcnow() > first_delay
+
+    smtp_handler.refuse.clear()
+    refused.next_attempt_on = datetime.utcnow()
+    db.session.commit()
+    run_mail_worker(batch_size=10, interval=0, once=True)
+    assert refused.sent_on is not None
+    assert [rcpt_tos for rcpt_tos, _ in smtp_handler.messages] == [
+        ['a@a.com'], ['b@a.com']]
+
+
+def test_emails_claimed_by_other_workers_are_skipped(database,
+                                                     smtp_handler):
+    queue_email('a@a.com')
+    queue_email('b@a.com')
+    db.session.commit()
+    locked_id = OutboxEmail.query.filter_by(recipients='a@a.com').one().id
+
+    with db.engine.connect() as other_worker:
+        transaction = other_worker.begin()
+        other_worker.execute(
+            'SELECT id FROM outbox_emails WHERE id = %s FOR UPDATE',
+            locked_id)
+        with mail.connect() as connection:
+            assert deliver_outbox_batch(connection, 10) == 1
+        transaction.rollback()
+
+    assert [rcpt_tos for rcpt_tos, _ in smtp_handler.messages] == [
+        ['b@a.com']]
+
+
+def test_emails_wait_while_the_server_is_down(app, database, smtp_handler):
+    queue_email('a@a.com')
+    db.session.commit()
+    app.config['MAIL_PORT'] += 1
+    mail.init_app(app)
+
+    run_mail_worker(batch_size=10, interval=0, once=True)
+    email = OutboxEmail.query.one()
+    assert email.sent_on is None
+    assert email.attempts == 0
+
+
+def test_worker_survives_failing_rounds(database, smtp_handler,
+                                        monkeypatch):
+    monkeypatch.setattr('app.utils.email.time.sleep', lambda seconds: None)
+    rounds = []
+
+    def job():
+        rounds.append(len(rounds) + 1)
+        if rounds[-1] == 1:
+            db.session.execute('SELECT 1 / 0')
+        elif rounds[-1] == 2:
+            queue_email('a@a.com')
+            db.session.commit()
+        else:
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        run_mail_worker(batch_size=10, interval=1, jobs=[job])
+    assert [rcpt_tos for rcpt_tos, _ in smtp_handler.messages] == [
+        ['a@a.com']]